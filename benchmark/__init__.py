@@ -0,0 +1,13 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
@@ -0,0 +1,248 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+'''
+End-to-end benchmark, collects ``N`` simulated devices (see
+:py:mod:`benchmark.simulator`) through :py:func:`ranrod.client.try_connect`,
+the device model, the dumper and a git repository, just like a real run::
+
+    $ python -m benchmark.collect --devices 50 --workers 8 --size 256
+
+The simulator runs in a separate process, so the reported CPU time and peak
+memory are those of the collector only.
+'''
+
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+from timeit import default_timer
+from benchmark.simulator import Options, Simulator
+from ranrod.config import ConfigMap
+from ranrod.client import try_connect
+from ranrod.client.reactor import reactor
+from ranrod.cluster import Coordinator, Worker
+from ranrod.logger import configure
+from ranrod.process import Processes
+from ranrod.repository import get_repository
+from ranrod.scheduler import Scheduler
+from ranrod.status import Status
+
+
+# Model for the simulated devices
+MODEL = r"""
+prompt(r'^router#\s*$')
+expect(r'^Username:', device.config.username)
+expect(r'^Password:', device.config.password)
+expect(r'--More--', ' ')
+ignore(r'--More--')
+ignore(r'^! Last configuration change')
+with connect(device):
+    prompt()
+    if device.config.get('fingerprint'):
+        fingerprint('show archive', r'Last change: (.*)')
+    with dumper(device) as output:
+        record(output, header(device.name))
+        command('show running-config', output)
+"""
+
+
+def simulate(port, protocol, options, ready):
+    server = Simulator(('127.0.0.1', port), protocol, options)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def usage():
+    '''
+    CPU time and peak RSS of this process and of its finished children,
+    except for the simulator, which is still running.
+    '''
+    cpu = 0
+    rss = 0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        cpu += usage.ru_utime + usage.ru_stime
+        rss = max(rss, usage.ru_maxrss)
+    return cpu, rss
+
+
+def collect(device, repository, status):
+    try:
+        try_connect(device, device.name, repository)
+    except Exception, e:
+        status.device_down(device, reason=str(e))
+    else:
+        status.device_up(device)
+
+
+def work(address, path, name, workers):
+    configure(dict(level='warning'))
+    Worker(address, collect, path=path, name=name, workers=workers,
+        retry=0.1).run()
+
+
+def run(devices, workers, protocol, port, root, batch=100,
+    fingerprint=False, processes=1, cluster=0):
+    '''
+    Collect ``devices`` devices from the simulator listening on ``port``.
+
+    :returns: (wall time, CPU time, bytes collected, failures)
+    '''
+    model = os.path.join(root, 'simulated')
+    with open(model, 'w') as handle:
+        handle.write(MODEL)
+    repository = get_repository(os.path.join(root, 'repository'),
+        backend='git', batch=batch)
+    status = Status(repository)
+
+    configs = []
+    for x in xrange(devices):
+        configs.append(ConfigMap(dict(
+            name = 'device%04d' % (x,),
+            model = model,
+            username = 'ranrod',
+            password = 'r4nr0d',
+            hostname = '127.0.0.1',
+            connect = 'tcp/%s:%d' % (protocol, port),
+            fingerprint = fingerprint,
+        )))
+
+    cpu = usage()[0]
+    start = default_timer()
+    with repository.batch():
+        if cluster:
+            # Local workers of a coordinator, like remote ones would be
+            coordinator = Coordinator(('127.0.0.1', 0), repository).start()
+            children = []
+            for x in xrange(cluster):
+                child = multiprocessing.Process(target=work, args=(
+                    coordinator.address, os.path.join(root, 'worker%d' % (x,)),
+                    'worker%d' % (x,), workers))
+                child.start()
+                children.append(child)
+            try:
+                coordinator.run(configs, status)
+            finally:
+                coordinator.close()
+                for child in children:
+                    child.terminate()
+                    child.join()
+        elif processes > 1:
+            Processes(processes, repository, log=dict(level='warning')).run(
+                configs, collect, status, workers)
+        else:
+            scheduler = Scheduler(workers)
+            for config in configs:
+                scheduler.add(collect, config, repository, status)
+            scheduler.run()
+    repository.close()
+    wall = default_timer() - start
+    cpu = usage()[0] - cpu
+    failures = [(row[0], row[3]) for row in status.status if row[2] == 'down']
+
+    size = 0
+    for name in os.listdir(os.path.join(root, 'repository', 'config')):
+        size += os.path.getsize(os.path.join(root, 'repository', 'config',
+            name))
+    return wall, cpu, size, failures
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--devices', dest='devices', type='int',
+        default=50, help='number of devices')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+        default=8, help='number of devices to collect concurrently')
+    parser.add_option('-P', '--processes', dest='processes', type='int',
+        default=1, help='number of worker processes')
+    parser.add_option('-c', '--cluster', dest='cluster', type='int',
+        default=0, help='number of local cluster workers, each running '
+                        'the given number of workers')
+    parser.add_option('-R', '--reactor', dest='reactor', action='store_true',
+        default=False, help='read all sessions in one I/O loop')
+    parser.add_option('-p', '--protocol', dest='protocol', default='telnet',
+        help='telnet or ssh')
+    parser.add_option('-s', '--size', dest='size', type='int', default=256,
+        help='configuration size per device (in kB)')
+    parser.add_option('-g', '--page', dest='page', type='int', default=0,
+        help='lines per page, 0 disables paging')
+    parser.add_option('-l', '--latency', dest='latency', type='float',
+        default=0, help='response latency (in ms)')
+    parser.add_option('-b', '--bandwidth', dest='bandwidth', type='int',
+        default=0, help='bandwidth per device (in kB/s), 0 for unlimited')
+    parser.add_option('-r', '--rounds', dest='rounds', type='int',
+        default=1, help='number of collections on the same repository')
+    parser.add_option('-F', '--fingerprint', dest='fingerprint',
+        action='store_true', default=False,
+        help='check the change fingerprint first, later rounds skip the '
+             'unchanged devices')
+    parser.add_option('-k', '--keep', dest='keep', action='store_true',
+        default=False, help='keep the repository')
+
+    options, args = parser.parse_args()
+
+    # Only warnings, logging every command would dominate the results
+    configure(dict(level='warning'))
+    reactor.enabled = options.reactor
+
+    ready = multiprocessing.Queue()
+    simulator = multiprocessing.Process(target=simulate, args=(0,
+        options.protocol, Options(options.size * 1024, options.page,
+        options.latency / 1000.0, options.bandwidth * 1024), ready))
+    simulator.daemon = True
+    simulator.start()
+    port = ready.get(timeout=60)
+
+    root = tempfile.mkdtemp(prefix='ranrod-bench-')
+    try:
+        for x in xrange(options.rounds):
+            wall, cpu, size, failures = run(options.devices,
+                options.workers, options.protocol, port, root,
+                fingerprint=options.fingerprint,
+                processes=options.processes, cluster=options.cluster)
+
+            for name, error in failures:
+                print '%s failed: %s' % (name, error)
+
+            megabytes = size / 1048576.0
+            print 'Collected %d devices, %.2f MB over %s using %d ' \
+                '%s of %d workers' % (options.devices - len(failures),
+                megabytes, options.protocol,
+                options.cluster or options.processes,
+                options.cluster and 'cluster workers' or 'processes',
+                options.workers)
+            print '%8.3fs %8.1f devices/s %8.2f MB/s' % (wall,
+                options.devices / wall, megabytes / wall)
+            print '%8.3fs CPU %8.3fs CPU/MB' % (cpu,
+                cpu / max(megabytes, 1e-9))
+    finally:
+        simulator.terminate()
+        if options.keep:
+            print 'Repository kept in', root
+        else:
+            shutil.rmtree(root)
+
+    # ru_maxrss is in kB on Linux
+    print '%8.1f MB peak RSS' % (usage()[1] / 1024.0,)
+    return failures and 1 or 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
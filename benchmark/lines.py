@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+
+'''
+Benchmark for the line tokenizer used by
+:py:meth:`ranrod.client.base.Client.nextline`, feeds it a large output in
+chunks as they would come off the wire::
+
+    $ python -m benchmark.lines --lines 1000000 --chunk 4096
+
+'''
+
+import random
+from timeit import default_timer
+from ranrod.client.base import Client
+from ranrod.client.constants import *
+
+
+def output(lines, seed=42):
+    '''
+    Generate ``lines`` lines of output, using mixed line endings.
+    '''
+    random.seed(seed)
+    newlines = [CR + LF] * 8 + [LF + CR, LF]
+    return ''.join(['interface GigabitEthernet0/%d%s' % (x,
+        random.choice(newlines)) for x in xrange(lines)])
+
+
+def run(data, chunk):
+    client = Client(('127.0.0.1', 0))
+    count = 0
+    size = 0
+    start = default_timer()
+    for offset in xrange(0, len(data), chunk):
+        client.buffer.write(data[offset:offset + chunk])
+        for line in client.nextlines():
+            count += 1
+            size += len(line)
+    return default_timer() - start, count, size
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('-l', '--lines', dest='lines', type='int',
+        default=1000000, help='number of lines')
+    parser.add_option('-c', '--chunk', dest='chunk', type='int',
+        default=4096, help='read size (in bytes)')
+
+    options, args = parser.parse_args()
+
+    data = output(options.lines)
+    print 'Output of %d lines, %d bytes, %d byte chunks' % (options.lines,
+        len(data), options.chunk)
+
+    seconds, count, size = run(data, options.chunk)
+    if count != options.lines or size != len(data):
+        print 'Tokenizer returned %d lines, %d bytes!' % (count, size)
+        return 1
+
+    print '%8.3fs %10.0f lines/s %8.2f MB/s' % (seconds, count / seconds,
+        size / seconds / 1048576.0)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
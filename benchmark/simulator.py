@@ -0,0 +1,356 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+'''
+Fake network device, serves a Cisco-like command line over Telnet or SSH so
+the collection path can be benchmarked without real routers::
+
+    $ python -m benchmark.simulator --protocol telnet --port 2323 --size 512
+
+The device asks for a username and password (Telnet only, SSH uses password
+authentication), negotiates Telnet options, pages output with ``--More--``
+until ``terminal length 0`` is given, and can add latency and limit the
+bandwidth of its responses.
+'''
+
+import random
+import re
+import socket
+import SocketServer
+import threading
+import time
+from ranrod.client.constants import *
+
+
+# Telnet commands in the input, and line endings
+IAC_RE = re.compile(re.escape(IAC) + '(?:' + re.escape(SB) + '.*?' +
+    re.escape(IAC + SE) + '|[' + re.escape(WILL + WONT + DO + DONT) +
+    '].|.)', re.S)
+NEWLINE_RE = re.compile(r'\r\n|\r\x00|\n|\r')
+
+
+def config(size, seed=42):
+    '''
+    Generate a ``show running-config`` output of about ``size`` bytes.
+    '''
+    rand = random.Random(seed)
+    lines = []
+    total = 0
+    x = 0
+    while total < size:
+        block = [
+            'interface GigabitEthernet0/%d' % (x,),
+            ' description %s' % (rand.choice(['uplink', 'customer', 'core',
+                'management']),),
+            ' ip address 10.%d.%d.1 255.255.255.0' % (x / 256 % 256, x % 256),
+            ' no shutdown',
+            '!',
+        ]
+        if x % 16 == 0:
+            block.insert(0, '! Last configuration change at %d' % (
+                rand.randint(0, 1 << 30),))
+        lines.extend(block)
+        total += sum(map(len, block)) + 2 * len(block)
+        x += 1
+    return lines
+
+
+class Options(object):
+    '''
+    Simulator options.
+
+    :param size: size of the configuration (in bytes)
+    :param page: lines per page, ``0`` disables paging
+    :param latency: delay before every response (in seconds)
+    :param bandwidth: maximum output rate (in bytes per second), ``0`` for
+                      no limit
+    '''
+
+    def __init__(self, size=65536, page=24, latency=0, bandwidth=0,
+        hostname='router'):
+        self.size = size
+        self.page = page
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.hostname = hostname
+        self.config = config(size)
+
+
+class Session(object):
+    '''
+    Command line session, independent of the transport.
+
+    :param options: :py:class:`Options` instance
+    :param recv: callable reading data from the peer
+    :param send: callable sending data to the peer
+    :param echo: echo input back to the peer
+    '''
+
+    def __init__(self, options, recv, send, echo=True):
+        self.options = options
+        self.recv = recv
+        self.raw_send = send
+        self.echo = echo
+        self.page = options.page
+        self.buffer = ''
+
+    def decode(self, data):
+        return data
+
+    def readline(self):
+        while True:
+            match = NEWLINE_RE.search(self.buffer)
+            if match:
+                line = self.buffer[:match.start()]
+                self.buffer = self.buffer[match.end():]
+                return line
+            data = self.recv(4096)
+            if not data:
+                raise EOFError
+            self.buffer += self.decode(data)
+
+    def send(self, data):
+        bandwidth = self.options.bandwidth
+        if not bandwidth:
+            return self.raw_send(data)
+        step = max(1, int(bandwidth / 10))
+        for offset in xrange(0, len(data), step):
+            part = data[offset:offset + step]
+            self.raw_send(part)
+            time.sleep(len(part) / float(bandwidth))
+
+    def prompt(self):
+        self.send('%s# ' % (self.options.hostname,))
+
+    def login(self):
+        self.send('\r\nUser Access Verification\r\n\r\nUsername: ')
+        self.readline()
+        self.send('Password: ')
+        self.readline()
+        self.send('\r\n')
+
+    def run(self, login=True):
+        try:
+            if login:
+                self.login()
+            self.prompt()
+            while True:
+                line = self.readline()
+                if self.echo:
+                    self.send(line)
+                self.send('\r\n')
+                if self.command(line.strip()) is False:
+                    return
+                self.prompt()
+        except (EOFError, socket.error):
+            pass
+
+    def command(self, line):
+        '''
+        Run a command, returns ``False`` if the session should end.
+        '''
+        if self.options.latency and line:
+            time.sleep(self.options.latency)
+        if not line:
+            return
+        elif line in ('exit', 'quit', 'logout'):
+            return False
+        elif line == 'terminal length 0':
+            self.page = 0
+        elif line in ('show running-config', 'show configuration'):
+            self.output(self.options.config)
+        elif line == 'show archive':
+            # The configuration never changes
+            self.output(['Archive feature enabled',
+                'Last change: 1 config change since boot'])
+        elif line == 'show version':
+            self.output(['Simulated IOS Software, Version 12.4(24)T',
+                'uptime is %d seconds' % (time.time(),)])
+        else:
+            self.send('% Invalid input detected\r\n')
+
+    def output(self, lines):
+        if not self.page:
+            self.send('\r\n'.join(lines) + '\r\n')
+            return
+
+        for offset in xrange(0, len(lines), self.page):
+            self.send('\r\n'.join(lines[offset:offset + self.page]) + '\r\n')
+            if offset + self.page < len(lines):
+                self.send(' --More-- ')
+                self.readline()
+                self.send('\r\n')
+
+
+class TelnetSession(Session):
+    '''
+    Session over Telnet, option negotiation is stripped from the input.
+    '''
+
+    def __init__(self, options, sock):
+        super(TelnetSession, self).__init__(options, sock.recv, sock.sendall)
+        self.send(IAC + WILL + ECHO + IAC + WILL + SUPPRESS_GO_AHEAD +
+            IAC + DO + TERM_TYPE)
+
+    def decode(self, data):
+        # Our client asks us not to echo
+        if IAC + DONT + ECHO in data:
+            self.echo = False
+        if IAC + WILL + TERM_TYPE in data:
+            self.raw_send(IAC + SB + TERM_TYPE + ECHO + IAC + SE)
+        return IAC_RE.sub('', data)
+
+
+class TelnetHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        # Don't let Nagle delay the --More-- prompts
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        TelnetSession(self.server.options, self.request).run()
+
+
+class SSHHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        import paramiko
+
+        options = self.server.options
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(self.request)
+        transport.add_server_key(self.server.host_key)
+        interface = SSHInterface(options)
+        transport.start_server(server=interface)
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is None:
+                continue
+            # Channels are accepted before the client asked for a shell or
+            # a command, wait for its request
+            requested = interface.requested.get(channel.get_id())
+            if requested is not None:
+                requested.wait(10)
+                interface.requested.pop(channel.get_id(), None)
+            if channel.get_name() == 'shell':
+                Session(options, channel.recv, channel.sendall).run(False)
+                channel.close()
+                break
+        transport.close()
+
+
+def SSHInterface(options):
+    import paramiko
+
+    class SSHInterface(paramiko.ServerInterface):
+        '''
+        Accepts any password, shell and exec channels.
+        '''
+
+        def __init__(self):
+            # Set once a channel requested a shell or exec, by channel id
+            self.requested = {}
+
+        def get_allowed_auths(self, username):
+            return 'password'
+
+        def check_auth_password(self, username, password):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_channel_request(self, kind, chanid):
+            if kind == 'session':
+                self.requested[chanid] = threading.Event()
+                return paramiko.OPEN_SUCCEEDED
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+        def check_channel_pty_request(self, *args):
+            return True
+
+        def check_channel_shell_request(self, channel):
+            channel.set_name('shell')
+            self.requested[channel.get_id()].set()
+            return True
+
+        def check_channel_exec_request(self, channel, command):
+            def run():
+                session = Session(options, channel.recv, channel.sendall,
+                    echo=False)
+                session.page = 0
+                session.command(command.strip())
+                channel.send_exit_status(0)
+                channel.close()
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+            self.requested[channel.get_id()].set()
+            return True
+
+    return SSHInterface()
+
+
+class Simulator(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''
+    Simulated device(s), every connection gets its own session.
+
+    :param address: (host, port) to listen on, use port ``0`` for any
+    :param protocol: ``telnet`` or ``ssh`` (requires paramiko)
+    :param options: :py:class:`Options` instance
+    '''
+
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, protocol='telnet', options=None):
+        self.options = options or Options()
+        if protocol == 'ssh':
+            import paramiko
+            self.host_key = paramiko.RSAKey.generate(1024)
+            handler = SSHHandler
+        else:
+            handler = TelnetHandler
+        SocketServer.TCPServer.__init__(self, address, handler)
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--protocol', dest='protocol', default='telnet',
+        help='telnet or ssh')
+    parser.add_option('-P', '--port', dest='port', type='int', default=2323,
+        help='port to listen on')
+    parser.add_option('-s', '--size', dest='size', type='int', default=64,
+        help='configuration size (in kB)')
+    parser.add_option('-g', '--page', dest='page', type='int', default=24,
+        help='lines per page, 0 disables paging')
+    parser.add_option('-l', '--latency', dest='latency', type='float',
+        default=0, help='response latency (in ms)')
+    parser.add_option('-b', '--bandwidth', dest='bandwidth', type='int',
+        default=0, help='bandwidth (in kB/s), 0 for unlimited')
+
+    options, args = parser.parse_args()
+
+    server = Simulator(('127.0.0.1', options.port), options.protocol,
+        Options(options.size * 1024, options.page, options.latency / 1000.0,
+            options.bandwidth * 1024))
+    print 'Simulating a %s device on %s:%d' % ((options.protocol,) +
+        server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
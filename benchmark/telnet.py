@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+'''
+Micro-benchmark for :py:meth:`ranrod.client.protocol.telnet.Telnet.process`,
+compares the byte-by-byte decoder we used to have with the current one::
+
+    $ python -m benchmark.telnet --size 20 --chunk 4096
+
+'''
+
+import io
+import random
+from timeit import default_timer
+from ranrod.client.constants import *
+from ranrod.client.protocol.telnet import Telnet
+
+
+class BenchTelnet(Telnet):
+    '''
+    Telnet client that is not connected, negotiation replies are dropped.
+    '''
+
+    def __init__(self):
+        super(BenchTelnet, self).__init__(('127.0.0.1', 23))
+
+    def send(self, *args, **kwargs):
+        pass
+
+
+class LegacyTelnet(BenchTelnet):
+    '''
+    Telnet client using the original byte-by-byte decoder.
+    '''
+
+    def process(self, data):
+        chunk = io.BytesIO()
+        for char in data:
+            if self.IAC:
+                if self.IACByte:
+                    if self.IACByte == SB:
+                        if char == SE:
+                            self.handle_IAC_SB(chunk.getvalue())
+                            chunk = io.BytesIO()
+                            self.IAC = False
+                            self.IACByte = None
+                        else:
+                            chunk.write(char)
+                    else:
+                        try:
+                            getattr(self, 'handle_IAC_%s' % \
+                                (NAME[self.IACByte]),)(char)
+                        except KeyError:
+                            pass
+                        self.IAC = False
+                        self.IACByte = None
+                else:
+                    self.IACByte = char
+
+            elif char == IAC:
+                self.IAC = True
+            else:
+                chunk.write(char)
+
+        return chunk.getvalue()
+
+
+def capture(size, every=4096, seed=42):
+    '''
+    Generate a fake ``show running-config`` capture of ``size`` bytes, with
+    a negotiation sequence about every ``every`` bytes.
+    '''
+    random.seed(seed)
+    words = ['interface', 'GigabitEthernet0/0/1', 'description', 'uplink',
+        'ip', 'address', '192.0.2.1', '255.255.255.0', 'no', 'shutdown',
+        'router', 'bgp', '64512', 'neighbor', 'remote-as', '!']
+    sequences = [IAC + WILL + ECHO, IAC + DO + TERM_SPEED,
+        IAC + WONT + SUPPRESS_GO_AHEAD, IAC + DONT + LM]
+    output = io.BytesIO()
+    offset = 0
+    while output.tell() < size:
+        line = ' '.join(random.sample(words, random.randint(1, 6)))
+        output.write(line + CR + LF)
+        if output.tell() - offset > every:
+            offset = output.tell()
+            output.write(random.choice(sequences))
+    return output.getvalue()
+
+
+def run(client, data, chunk):
+    output = []
+    start = default_timer()
+    for offset in xrange(0, len(data), chunk):
+        output.append(client.process(data[offset:offset + chunk]))
+    return default_timer() - start, ''.join(output)
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--size', dest='size', type='int', default=4,
+        help='capture size (in MB)')
+    parser.add_option('-c', '--chunk', dest='chunk', type='int', default=1024,
+        help='read size (in bytes)')
+    parser.add_option('-e', '--every', dest='every', type='int', default=4096,
+        help='bytes between negotiation sequences')
+
+    options, args = parser.parse_args()
+
+    data = capture(options.size * 1024 * 1024, options.every)
+    print 'Capture of %d bytes, %d byte chunks' % (len(data), options.chunk)
+
+    legacy_time, legacy = run(LegacyTelnet(), data, options.chunk)
+    fast_time, fast = run(BenchTelnet(), data, options.chunk)
+    if legacy != fast:
+        print 'Output mismatch!'
+        return 1
+
+    for name, seconds in [('legacy', legacy_time), ('current', fast_time)]:
+        print '%-8s %8.3fs %8.2f MB/s' % (name, seconds,
+            len(data) / seconds / 1048576.0)
+    print 'speedup  %8.1fx' % (legacy_time / fast_time,)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
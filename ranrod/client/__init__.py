@@ -16,12 +16,18 @@ __license__   = 'MIT'
 __all__ = ['get_service', 'try_connect']
 
 
+import os
 import re
 from ranrod.client.error import *
+from ranrod.client.race import race
 from ranrod.device.error import *
 from ranrod.device.base import Device
 from ranrod.client.protocol.telnet import Telnet
 from ranrod.client.protocol.ssh import SSH
+from ranrod.latency import Latency
+from ranrod.logger import Logger
+from ranrod.metrics import registry
+from ranrod.timing import timings
 
 
 PROTOCOL_RE = re.compile(r'^(?P<proto>tcp|udp)/(?P<name>\w+):?(?P<port>\d*)$')
@@ -29,6 +35,11 @@ SERVICE_MAP = dict(
     telnet = Telnet,
     ssh = SSH,
 )
+CLIENT_ERRORS = registry.counter('ranrod_client_errors_total',
+    'Client errors, such as timeouts and connection errors',
+    ['protocol', 'error'])
+RACES = registry.counter('ranrod_client_races_total',
+    'Connect races, by winning protocol', ['protocol'])
 
 
 def get_service(desc):
@@ -56,13 +67,22 @@ def get_service(desc):
 
         return SERVICE_MAP[info['name']], port
 
-def try_connect(config, name, repository):
+def try_connect(config, name, repository, pool=None):
     '''
     Try to establish a connection to a device.
 
+    The ``connect`` methods are tried in order, starting with the method
+    that last collected the device. If ``race`` is enabled for the device,
+    TCP connections to all methods are started at once, ``race_stagger``
+    seconds apart, and the first method to connect is used; the methods that
+    failed to connect are not tried again, see
+    :py:func:`ranrod.client.race.race`.
+
     :param config: device configuration
     :param name: device name
     :param repository: :class:`ranrod.repository.Repository` instance
+    :param pool: optional :class:`ranrod.client.pool.Pool` instance, to
+                 reuse sessions from
 
     :returns: :class:`ranrod.device.Device` instance
 
@@ -71,26 +91,78 @@ def try_connect(config, name, repository):
     if type(config.connect) != list:
         config.connect = [config.connect]
 
-    for method in config.connect:
+    # Start with the method that worked last time
+    filename = os.path.join('config', name)
+    methods = list(config.connect)
+    last = repository.method(filename)
+    if last in methods:
+        methods.remove(last)
+        methods.insert(0, last)
+
+    sock = None
+    if len(methods) > 1 and config.get('race') and \
+        not (pool is not None and name in pool):
+        latency = Latency(config, repository.latency(filename))
+        methods, sock = race_methods(config, name, methods,
+            latency.timeout('connect'))
+
+    for method in methods:
         factory, port = get_service(method)
         config.address = (config.hostname, port)
-        device = Device(config, name, factory, repository)
+        device = Device(config, name, factory, repository, pool)
+        # Only the first method can have won the race
+        device.sock, sock = sock, None
         try:
             try:
                 device.parse(config.model)
             except ClientError, e:
-                print 'Cient error using "%s": %s' % (method, str(e))
+                CLIENT_ERRORS.labels(factory.name, e.__class__.__name__).inc()
+                device.logger('Client error using "%s": %s' % (method,
+                    str(e)), level='warning')
             except Exception, e:
-                print 'Unhandled error: %s' % (str(e),)
+                device.logger('Unhandled error: %s' % (str(e),),
+                    level='warning')
                 raise
             else:
+                if method != last:
+                    repository.set_method(filename, method)
                 return device
         finally:
-            pass # device.close()
+            # Not handed to a client
+            if device.sock is not None:
+                device.sock.close()
 
     raise DeviceError('No suitable connections available')
 
 
+def race_methods(config, name, methods, timeout=30):
+    '''
+    Race the TCP connections of the ``connect`` methods of a device.
+
+    :param timeout: connect timeout (in seconds)
+
+    :returns: ``(methods, socket)``, the winner followed by the methods that
+              neither won nor failed, and the socket of the winner
+    '''
+    addresses = [(config.hostname, get_service(method)[1])
+        for method in methods]
+    with timings.measure('race', name):
+        index, sock, failed = race(addresses, timeout=timeout,
+            stagger=float(config.get('race_stagger', 1.0)))
+
+    log = Logger(device=name)
+    if index is None:
+        log('No connect method connected', level='warning')
+        raise DeviceError('No suitable connections available')
+
+    winner = methods[index]
+    RACES.labels(get_service(winner)[0].name).inc()
+    log('Connect race won by "%s"' % (winner,), level='debug')
+    rest = [method for x, method in enumerate(methods)
+        if x != index and not x in failed]
+    return [winner] + rest, sock
+
+
 if __name__ == '__main__':
     print get_service('tcp/telnet')
     print get_service('tcp/telnet:2300')
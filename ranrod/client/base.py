@@ -13,9 +13,23 @@ __copyright__ = 'Copyright 2011, maze.io labs'
 __license__   = 'MIT'
 
 
+import re
+import select
+import threading
+import time
+from ranrod.client.buffer import Buffer
 from ranrod.client.constants import CR, LF
 from ranrod.client.error import *
+from ranrod.client.expect import Expect
+from ranrod.client.reactor import reactor
+from ranrod.client.trace import tracer
+from ranrod.timing import timings
 from ranrod.config import ConfigMap
+from ranrod.metrics import registry
+
+
+BYTES_RECEIVED = registry.counter('ranrod_client_received_bytes_total',
+    'Bytes received from devices', ['protocol'])
 
 
 class Client(object):
@@ -25,6 +39,8 @@ class Client(object):
 
     name = 'unknown'
     port = 0
+    # Client can run commands on separate channels, see execute
+    channels = False
     defaults = {
         'timeout':  30.0,
         'newlines': [CR + LF, LF + CR, LF],
@@ -34,6 +50,28 @@ class Client(object):
         self.address = address
         self.config = ConfigMap(self.defaults.copy())
         self.config.update(config)
+        # Receive buffer
+        self.buffer = Buffer()
+        # Line endings, longest first so CR LF is not split at the LF
+        newlines = sorted(self.config['newlines'], key=len, reverse=True)
+        self.newline = re.compile('|'.join(map(re.escape, newlines)))
+        self.newline_size = max(map(len, newlines))
+        # Cached expect matcher
+        self.expects = None
+        # Longest wait for data in readloop, reset by the caller
+        self.slowest = 0.0
+        # Reactor reading for this client, see ranrod.client.reactor; it
+        # holds the lock while filling the buffer and sets ready after
+        self.reactor = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.error = None
+        # Metrics
+        self.received = BYTES_RECEIVED.labels(self.name)
+        # Wire trace, see ranrod.client.trace
+        self.trace = tracer.open(self)
+        if self.trace is not None:
+            self.traced(self.trace)
 
     def __str__(self):
         if self.address[1] == self.port:
@@ -42,9 +80,13 @@ class Client(object):
             return '%s://%s:%d' % (self.name, self.address[0],
                 self.address[1])
 
-    def connect(self):
+    def connect(self, sock=None, timeout=None):
         '''
         To be implemented in the sub class.
+
+        :param sock: already connected socket to use, optional
+        :param timeout: connect timeout (in seconds), defaults to the
+                        ``timeout`` option
         '''
         raise NotImplementedError
 
@@ -52,27 +94,58 @@ class Client(object):
         '''
         To be implemented in the sub class.
         '''
-        self.remote.close()
+        try:
+            if self.reactor is not None:
+                self.reactor.unregister(self)
+            self.remote.close()
+        finally:
+            if self.trace is not None:
+                self.trace.close()
+
+    def traced(self, trace):
+        '''
+        Write all data sent and received to ``trace``. The ``send`` and
+        ``read`` methods are wrapped for this client only, so clients that
+        are not traced do not pay for it.
+
+        :param trace: :py:class:`ranrod.client.trace.Trace` instance
+        '''
+        send, read = self.send, self.read
+
+        def traced_send(*args, **kwargs):
+            trace.write('>>>', ''.join(args))
+            return send(*args, **kwargs)
+
+        def traced_read(*args, **kwargs):
+            data = read(*args, **kwargs)
+            trace.write('<<<', data)
+            return data
+
+        self.send, self.read = traced_send, traced_read
 
     def nextline(self):
         '''
-        Check if we have a new line in the buffer, we do this by checking
-        all possible line endings.
+        Check if we have a new line in the buffer, we do this by looking for
+        the earliest of all possible line endings in a single scan.
+        '''
+        line = self.buffer.readline(self.newline, self.newline_size - 1)
+        if line is None:
+            raise ValueError('No line in buffer')
+        else:
+            return line
+
+    def nextlines(self):
+        '''
+        Yield all complete lines in the buffer, in order.
         '''
-        for feed in self.config['newlines']:
-            newline = self.buffer.index(feed) + len(feed)
-            output = self.buffer[:newline]
-            self.buffer = self.buffer[newline:]
-        return output
+        return self.buffer.readlines(self.newline, self.newline_size - 1)
 
     def nextpart(self):
         '''
         Check if we still have (some) buffer remaining, if so, return that.
         '''
         if self.buffer:
-            chunk = self.buffer
-            self.buffer = ''
-            return chunk
+            return self.buffer.read()
         else:
             raise ValueError('Empty buffer')
 
@@ -82,33 +155,111 @@ class Client(object):
         '''
         return chunk
 
-        def readloop(self, callback, timeout=None):
-            timeout = timeout or self.config['timeout']
-            print 'timeout =', timeout
-            chunk = ''
+    def execute(self, commands, timeout=None):
+        '''
+        Run ``commands`` without going through the interactive session, to be
+        implemented in the sub class if :py:attr:`channels` is set.
 
-            try:
-                return callback()
-            except ValueError:
-                pass
+        :returns: list of outputs, in the order of ``commands``
+        '''
+        raise NotImplementedError
 
-            # Read socket until there is no data available
-            while True:
-                r, w, e = select.select([self.remote], [], [], timeout)
-                if r:
-                    chunk = self.read(timeout=timeout)
-                    if chunk:
-                        self.buffer += self.process(chunk)
-                        try:
-                            return callback()
-                        except ValueError:
-                            pass
-                    else:
-                        # Socket was readable, but it returned no data so peer
-                        # must have gone away
-                        raise ClientError('Connection closed by peer')
-                else:
-                    raise ClientTimeout('Read timeout')
+    def fileno(self):
+        '''
+        File descriptor of the remote, allows clients to be used with
+        :py:func:`select.select`.
+        '''
+        return self.remote.fileno()
+
+    def read(self, size=1024, timeout=None):
+        '''
+        To be implemented in the sub class.
+        '''
+        raise NotImplementedError
+
+    def receive(self, size=1024):
+        '''
+        Read a chunk of data from the remote into the buffer.
+
+        :returns: ``False`` if the peer closed the connection
+        '''
+        chunk = self.read(size)
+        if chunk:
+            self.received.inc(len(chunk))
+            self.buffer.write(self.process(chunk))
+            return True
+        else:
+            return False
+
+    def readloop(self, callback, timeout=None):
+        '''
+        Keep reading data until the callback is satisfied.
+
+        The remote is only read when :py:func:`select.select` reports it
+        readable, so reads never block and the remote timeout does not have
+        to be adjusted for every call. If the
+        :py:class:`ranrod.client.reactor.Reactor` is enabled, it does the
+        reading and we only wait for it.
+
+        :param callback: callback to call once data is received, should
+                         raise :py:exc:`ValueError` if it needs more data
+
+        Optionally:
+
+        :param timeout: idle timeout (in seconds)
+        '''
+        timeout = timeout or self.config['timeout']
+
+        if self.reactor is None and reactor.enabled and self.error is None:
+            reactor.register(self)
+        if self.reactor is not None or self.error is not None:
+            return self.readwait(callback, timeout)
+
+        try:
+            return callback()
+        except ValueError:
+            pass
+
+        # Read remote until the callback is satisfied
+        while True:
+            started = time.time()
+            r, w, e = select.select([self.remote], [], [], timeout)
+            if r:
+                waited = time.time() - started
+                if waited > self.slowest:
+                    self.slowest = waited
+                if not self.receive():
+                    # Remote was readable, but it returned no data so peer
+                    # must have gone away
+                    raise ClientError('Connection closed by peer')
+                try:
+                    return callback()
+                except ValueError:
+                    pass
+            else:
+                raise ClientTimeout('Read timeout')
+
+    def readwait(self, callback, timeout):
+        '''
+        Wait for the reactor to read data until the callback is satisfied,
+        see :py:meth:`readloop`.
+        '''
+        while True:
+            with self.lock:
+                try:
+                    return callback()
+                except ValueError:
+                    pass
+                if self.error is not None:
+                    raise self.error
+                self.ready.clear()
+
+            started = time.time()
+            if not self.reactor.wait(self, timeout):
+                raise ClientTimeout('Read timeout')
+            waited = time.time() - started
+            if waited > self.slowest:
+                self.slowest = waited
 
     def readline(self, timeout=None):
         return self.readloop(self.nextline, timeout)
@@ -116,42 +267,85 @@ class Client(object):
     def readpart(self, timeout=None):
         return self.readloop(self.nextpart, timeout)
 
-    def readsome(self, timeout=None):
+    def nextsome(self):
+        '''
+        Get the next line from the buffer, or the remaining (incomplete) part
+        if there is no complete line.
+        '''
         try:
             return self.nextline()
         except ValueError:
-            pass
-        try:
             return self.nextpart()
-        except ValueError:
-            pass
-        return self.readpart(timeout)
 
-    def wait_for(self, pattern, timeout=None, callbacks={}):
+    def readsome(self, timeout=None):
+        return self.readloop(self.nextsome, timeout)
+
+    def expect(self, callbacks):
+        '''
+        Get a :py:class:`ranrod.client.expect.Expect` matcher for the given
+        ``callbacks``, the matcher is reused for as long as the callbacks
+        remain the same.
+        '''
+        key = frozenset(callbacks.iteritems())
+        if self.expects is None or self.expects[0] != key:
+            self.expects = (key, Expect(callbacks))
+        return self.expects[1]
+
+    def wait_for(self, pattern, timeout=None, callbacks={}, output=None):
         '''
         This loop will block until ``pattern`` is matched in the data received
         by the client. Furthermore, you can provide a dictionary with regular
         experession objects as keys, and a callback as value that will be
         called if matched on the current line being processed.
+
+        The prompt is only looked for in the tail of the output, that is the
+        line that has not been terminated yet. Callbacks fire at most once
+        for the same data, either when they match the unterminated tail (such
+        as a ``Password:`` prompt) or when the line is complete; data that
+        arrives on the same line after a callback fired is matched on its
+        own.
+
+        If an ``output`` callable is given, every complete line is passed to
+        it as soon as it is received instead of being kept in memory, and
+        only the tail (the line holding the prompt) is returned.
         '''
+        expect = self.expect(callbacks)
+        newlines = tuple(self.config['newlines'])
         seen = []
-        while True:
-            part = self.readsome(timeout=timeout)
-            seen.append(part)
+        tail = []
+        fired = 0
+        with timings.measure('wait_for') as measure:
+            while True:
+                part = self.readsome(timeout=timeout)
+                measure.size += len(part)
+
+                # Parts are either a complete line, or (a piece of) the tail
+                tail.append(part)
+                if len(tail) == 1:
+                    data = part
+                else:
+                    data = ''.join(tail)
+                complete = part.endswith(newlines)
+                if complete:
+                    tail = []
+                    if output is None:
+                        seen.append(data)
+                    else:
+                        output(data)
 
-            # Now investigate the bits read line-for-line
-            for line in part.splitlines():
                 # Cleanup
-                line = line.strip()
-                if not line:
-                    continue
-
-                # Return if the expected pattern matches
-                if pattern.search(line):
-                    return ''.join(seen)
-
-                # Iterate over possible callbacks
-                for cpattern, callback in callbacks.iteritems():
-                    match = cpattern.search(line)
-                    if match:
-                        callback(line, match)
+                line = data.strip()
+                if line:
+                    # Return if the expected pattern matches the tail
+                    if not complete and pattern.search(line):
+                        seen.append(data)
+                        return ''.join(seen)
+
+                    # Check possible callbacks, only on the data received after
+                    # a callback last fired on this line
+                    rest = data[fired:].strip()
+                    if rest and expect(rest):
+                        fired = len(data)
+
+                if complete:
+                    fired = 0
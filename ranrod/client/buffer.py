@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+
+__all__ = ['Buffer']
+
+
+class Buffer(object):
+    '''
+    Receive buffer backed by a :py:class:`bytearray`.
+
+    Data is appended at the end and consumed from a read offset, so taking a
+    line from the buffer does not copy the data that remains. The consumed
+    head is only discarded once it makes up the larger part of the buffer,
+    which keeps the cost of compaction amortised linear.
+
+    Searches remember up to where the data has been scanned, so waiting for a
+    line ending does not rescan the same data for every chunk received.
+
+    Line endings are given as a compiled regular expression, so all possible
+    line endings are found in a single scan::
+
+        >>> buffer = Buffer()
+        >>> buffer.write('foo\r\nbar\nb')
+        >>> list(buffer.readlines(re.compile(r'\r\n|\n\r|\n')))
+        ['foo\r\n', 'bar\n']
+
+
+    :param compact: minimal number of consumed bytes before compacting
+    '''
+
+    def __init__(self, compact=65536):
+        self.data = bytearray()
+        self.offset = 0
+        self.scanned = 0
+        self.compact_size = compact
+
+    def __len__(self):
+        return len(self.data) - self.offset
+
+    def __nonzero__(self):
+        return len(self.data) > self.offset
+
+    def __str__(self):
+        return str(self.data[self.offset:])
+
+    def write(self, data):
+        '''
+        Append ``data`` to the buffer.
+        '''
+        self.data.extend(data)
+
+    def search(self, pattern, overlap=0):
+        '''
+        Search the unread data for the compiled regular expression
+        ``pattern``, starting at the position where the previous
+        unsuccessful search stopped.
+
+        :param pattern: compiled regular expression
+        :param overlap: number of bytes to rescan, for patterns that may have
+                        been cut off at the end of the previous search
+
+        :returns: tuple of the start and end offset of the match relative to
+                  the read offset, or ``None``
+        '''
+        start = max(self.offset, self.scanned - overlap)
+        match = pattern.search(self.data, start)
+        if match is None:
+            self.scanned = len(self.data)
+            return None
+        else:
+            return match.start() - self.offset, match.end() - self.offset
+
+    def readline(self, pattern, overlap=0):
+        '''
+        Consume a line from the buffer, the line ends where ``pattern``
+        matches (see :py:meth:`search`).
+
+        :returns: line including its line ending, or ``None``
+        '''
+        span = self.search(pattern, overlap)
+        if span is None:
+            return None
+        else:
+            return self.read(span[1])
+
+    def readlines(self, pattern, overlap=0):
+        '''
+        Consume all complete lines from the buffer, yields them in order.
+        '''
+        while True:
+            line = self.readline(pattern, overlap)
+            if line is None:
+                break
+            yield line
+
+    def read(self, size=None):
+        '''
+        Consume ``size`` bytes from the buffer, or everything if ``size`` is
+        omitted.
+        '''
+        if size is None or size > len(self):
+            size = len(self)
+
+        end = self.offset + size
+        data = str(self.data[self.offset:end])
+        self.offset = end
+        self.compact()
+        return data
+
+    def compact(self):
+        '''
+        Discard the consumed head of the buffer, if worthwhile.
+        '''
+        if self.offset == len(self.data):
+            self.data = bytearray()
+            self.offset = 0
+            self.scanned = 0
+        elif self.offset >= self.compact_size and \
+            self.offset * 2 >= len(self.data):
+            del self.data[:self.offset]
+            self.scanned = max(0, self.scanned - self.offset)
+            self.offset = 0
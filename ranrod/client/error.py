@@ -13,7 +13,8 @@ __copyright__ = 'Copyright 2011, maze.io labs'
 __license__   = 'MIT'
 
 
-__all__ = ['ClientError', 'ClientTimeout', 'ClientConnectionError']
+__all__ = ['ClientError', 'ClientTimeout', 'ClientConnectionError',
+    'ClientRefused']
 
 
 class ClientError(Exception):
@@ -35,3 +36,11 @@ class ClientConnectionError(ClientError):
     Error indicating that an error on the network connection has occurred.
     '''
     pass
+
+
+class ClientRefused(ClientError):
+    '''
+    Error indicating that the remote refused a request, such as opening an
+    exec channel.
+    '''
+    pass
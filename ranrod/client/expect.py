@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+
+__all__ = ['Expect']
+
+
+import re
+
+
+# Patterns that use back references can not be merged with others, as the
+# group numbers would shift
+BACKREF_RE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class Expect(object):
+    '''
+    Matches lines against a dictionary of expected patterns and calls the
+    associated callbacks.
+
+    Most lines in a command output match none of the expected patterns, so
+    the patterns are merged into one alternation per set of flags that is
+    used as a prefilter; each line is scanned once, and the individual
+    patterns are only tried on lines that passed the prefilter.
+
+    :param callbacks: dictionary of compiled regular expressions as keys and
+                      callbacks as values
+    '''
+
+    def __init__(self, callbacks={}):
+        self.groups = []
+        self.always = []
+
+        grouped = {}
+        for pattern, callback in callbacks.iteritems():
+            if BACKREF_RE.search(pattern.pattern):
+                self.always.append((pattern, callback))
+            else:
+                grouped.setdefault(pattern.flags, []).append(
+                    (pattern, callback))
+
+        for flags, items in grouped.iteritems():
+            if len(items) == 1:
+                self.always.extend(items)
+                continue
+
+            try:
+                prefilter = re.compile('|'.join(['(?:%s)' % (item[0].pattern,)
+                    for item in items]), flags)
+            except (re.error, AssertionError, OverflowError):
+                # For example duplicate group names, or too many groups
+                self.always.extend(items)
+            else:
+                self.groups.append((prefilter, items))
+
+    def __call__(self, line):
+        '''
+        Call the callbacks of all patterns matching ``line``.
+
+        :returns: boolean indicating if any callback was called
+        '''
+        fired = False
+        for prefilter, items in self.groups:
+            if prefilter.search(line):
+                fired = self.dispatch(line, items) or fired
+        if self.always:
+            fired = self.dispatch(line, self.always) or fired
+        return fired
+
+    def dispatch(self, line, items):
+        fired = False
+        for pattern, callback in items:
+            match = pattern.search(line)
+            if match:
+                callback(line, match)
+                fired = True
+        return fired
@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+
+import threading
+import time
+from ranrod.client.error import ClientError
+from ranrod.logger import Logger
+
+
+class Session(object):
+    '''
+    An authenticated client kept in the :py:class:`Pool`.
+
+    :param client: :py:class:`ranrod.client.base.Client` instance
+    :param prompt: compiled prompt pattern of the device
+    '''
+
+    def __init__(self, client, prompt):
+        self.client = client
+        self.prompt = prompt
+        self.used = time.time()
+
+    def idle(self):
+        return time.time() - self.used
+
+
+class Pool(object):
+    '''
+    Pool of authenticated device sessions, keyed by device name, so that
+    subsequent polling cycles can skip connection setup and login.
+
+    Sessions that have been idle for longer than ``idle`` seconds are closed,
+    at most ``size`` sessions are kept; if the pool is full the least
+    recently used session is closed to make room. Before a session is handed
+    out again it has to pass a health check: an empty line is sent and the
+    device must return to its prompt within ``check`` seconds.
+
+    :param size: maximum number of sessions
+    :param idle: idle timeout (in seconds)
+    :param check: health check timeout (in seconds)
+    '''
+
+    def __init__(self, size=32, idle=600, check=5):
+        self.size = max(0, int(size))
+        self.idle = float(idle)
+        self.check = float(check)
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.logger = Logger()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, name):
+        return name in self.sessions
+
+    def checkout(self, name, address):
+        '''
+        Get a healthy session for a device, the session is removed from the
+        pool for as long as it is in use.
+
+        :param name: device name
+        :param address: device address, a session is only reused if the
+                        device is still at the same address
+
+        :returns: :py:class:`Session` instance or ``None``
+        '''
+        self.expire()
+        with self.lock:
+            session = self.sessions.pop(name, None)
+        if session is None:
+            return None
+        elif session.client.address != address:
+            # Session for another connection method, leave it for now
+            with self.lock:
+                self.sessions.setdefault(name, session)
+            return None
+        elif not self.healthy(session):
+            self.discard(name, session, 'failed health check')
+            return None
+        else:
+            self.logger('Reusing session %s for %s' % (session.client, name),
+                level='debug')
+            return session
+
+    def checkin(self, name, client, prompt):
+        '''
+        Return a session to the pool.
+
+        :param name: device name
+        :param client: :py:class:`ranrod.client.base.Client` instance
+        :param prompt: compiled prompt pattern of the device
+        '''
+        if not self.size or not prompt:
+            self.close_client(client)
+            return
+
+        self.expire()
+        expired = []
+        with self.lock:
+            if name in self.sessions:
+                expired.append((name, self.sessions.pop(name)))
+            while len(self.sessions) >= self.size:
+                oldest = min(self.sessions,
+                    key=lambda key: self.sessions[key].used)
+                expired.append((oldest, self.sessions.pop(oldest)))
+            self.sessions[name] = Session(client, prompt)
+
+        for name, session in expired:
+            self.discard(name, session, 'pool full')
+
+    def healthy(self, session):
+        '''
+        Check if a session is still usable, by doing a prompt round-trip.
+        '''
+        client = session.client
+        try:
+            # Anything the device sent while idle is of no interest
+            with client.lock:
+                client.buffer.read()
+            client.sendline('', timeout=self.check)
+            client.wait_for(session.prompt, timeout=self.check)
+        except (ClientError, EnvironmentError), e:
+            self.logger('Health check of session %s failed: %s' % (client,
+                str(e)), level='debug')
+            return False
+        else:
+            session.used = time.time()
+            return True
+
+    def expire(self):
+        '''
+        Close all sessions that exceeded the idle timeout.
+        '''
+        expired = []
+        with self.lock:
+            for name, session in self.sessions.items():
+                if session.idle() > self.idle:
+                    expired.append((name, self.sessions.pop(name)))
+
+        for name, session in expired:
+            self.discard(name, session, 'idle timeout')
+
+    def discard(self, name, session, reason):
+        self.logger('Closing session %s for %s: %s' % (session.client, name,
+            reason), level='debug')
+        self.close_client(session.client)
+
+    def close_client(self, client):
+        try:
+            client.close()
+        except (ClientError, EnvironmentError), e:
+            self.logger('Closing session %s failed: %s' % (client, str(e)),
+                level='debug')
+
+    def close(self):
+        '''
+        Close all sessions.
+        '''
+        with self.lock:
+            sessions = self.sessions.items()
+            self.sessions = {}
+
+        for name, session in sessions:
+            self.discard(name, session, 'shutting down')
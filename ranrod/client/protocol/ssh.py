@@ -15,11 +15,12 @@ __license__   = 'MIT'
 
 import io
 import paramiko
+import select
 import socket
 from ranrod.client.base import Client
-from ranrod.client.error import ClientError, ClientTimeout, ClientConnectionError
+from ranrod.client.error import ClientError, ClientTimeout, \
+    ClientConnectionError, ClientRefused
 from ranrod.client.constants import *
-from ranrod.util.hexdump import HexDump
 
 
 class SSH(Client):
@@ -29,23 +30,22 @@ class SSH(Client):
 
     name = 'ssh'
     port = 22
+    channels = True
     defaults = {
         # Tell the server not to echo our input
         'timeout':  30,
         # Possible newline combinations
         'newlines': [CR + LF, LF + CR, LF],
+        # Maximum number of concurrent exec channels
+        'exec_channels': 4,
     }
 
-    def __init__(self, address, config={}):
-        super(SSH, self).__init__(address, config)
-
-        # Receive buffer
-        self.buffer = ''
-
-    def connect(self):
+    def connect(self, sock=None, timeout=None):
         '''
         Establish a connection to the device.
         
+        :param sock: already connected socket to use, optional
+        :param timeout: connect timeout (in seconds), optional
         :raises: :class:`ClientConnectionError`
         '''
         self.transport = paramiko.SSHClient()
@@ -59,46 +59,104 @@ class SSH(Client):
                 username = self.config.username,
                 password = self.config.password,
                 key_filename = ssh_keyfile and [ssh_keyfile] or None,
-                timeout = self.config.timeout,
+                timeout = timeout or self.config.timeout,
+                sock = sock,
             )
             # Request a shell SSH channel
             self.remote = self.transport.invoke_shell()
+            self.remote.settimeout(self.config.timeout)
         except socket.error, e:
             raise ClientConnectionError(e)
 
     def close(self):
-        self.remote.close()
+        super(SSH, self).close()
         self.transport.close()
 
-    def send(self, *args, **kwargs):
-        data = ''.join(args)
-        timeout = kwargs.get('timeout', self.config['timeout'])
-        print '>>>'
-        self.debug(data)
-        oldtimeout = self.remote.gettimeout()
-        self.remote.settimeout(timeout)
+    def execute(self, commands, timeout=None):
+        '''
+        Run ``commands`` on exec channels, up to ``exec_channels`` of them in
+        parallel over the transport of the interactive session. The output of
+        a command is complete once the device closes its channel, so there is
+        no need to wait for prompts.
+
+        :param commands: list of commands
+        :param timeout: idle timeout (in seconds)
+
+        :returns: list of outputs, in the order of ``commands``
+
+        :raises: :class:`ClientRefused` if the device refuses exec channels,
+                 :class:`ClientTimeout` if a command timed out
+        '''
+        timeout = timeout or self.config.timeout
+        limit = max(1, int(self.config.exec_channels))
+        transport = self.transport.get_transport()
+        pending = list(enumerate(commands))
+        running = {}
+        output = [[] for command in commands]
         try:
-            return self.remote.send(data)
+            while pending or running:
+                while pending and len(running) < limit:
+                    index, command = pending.pop(0)
+                    try:
+                        channel = transport.open_session()
+                        running[channel] = index
+                        channel.set_combine_stderr(True)
+                        channel.exec_command(command)
+                    except paramiko.SSHException, e:
+                        raise ClientRefused('Exec channel refused: %s' % (
+                            str(e),))
+
+                r, w, e = select.select(running.keys(), [], [], timeout)
+                if not r:
+                    raise ClientTimeout('Read timeout')
+                for channel in r:
+                    data = channel.recv(32768)
+                    if data:
+                        output[running[channel]].append(data)
+                    else:
+                        # Command finished
+                        channel.close()
+                        del running[channel]
+
+        except paramiko.SSHException, e:
+            raise ClientError('Exec channel failed: %s' % (str(e),))
+
         finally:
-            self.remote.settimeout(oldtimeout)
+            for channel in running:
+                channel.close()
+
+        output = [''.join(data) for data in output]
+        self.received.inc(sum(map(len, output)))
+        return output
+
+    def send(self, *args, **kwargs):
+        data = ''.join(args)
+        timeout = kwargs.get('timeout')
+        if timeout is None:
+            return self.remote.sendall(data)
+        else:
+            oldtimeout = self.remote.gettimeout()
+            self.remote.settimeout(timeout)
+            try:
+                return self.remote.sendall(data)
+            finally:
+                self.remote.settimeout(oldtimeout)
 
     def sendline(self, line, timeout=None):
         self.send(line, CR, LF, timeout=timeout)
 
     def read(self, size=1024, timeout=None):
-        oldtimeout = self.remote.gettimeout()
-        self.remote.settimeout(timeout or self.config['timeout'])
-        try:
+        if timeout is None:
             data = self.remote.recv(size)
-        finally:
-            self.remote.settimeout(oldtimeout)
-        print '<<<'
-        self.debug(data)
+        else:
+            oldtimeout = self.remote.gettimeout()
+            self.remote.settimeout(timeout)
+            try:
+                data = self.remote.recv(size)
+            finally:
+                self.remote.settimeout(oldtimeout)
         return data
 
-    def debug(self, data):
-        HexDump(step=32).dump(data)
-
 
 if __name__ == '__main__':
     import sys
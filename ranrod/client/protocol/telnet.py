@@ -13,13 +13,10 @@ __copyright__ = 'Copyright 2011, maze.io labs'
 __license__   = 'MIT'
 
 
-import io
-import select
 import socket
 from ranrod.client.base import Client
 from ranrod.client.error import ClientError, ClientTimeout, ClientConnectionError
 from ranrod.client.constants import *
-from ranrod.util.hexdump import HexDump
 
 
 class Telnet(Client):
@@ -48,24 +45,27 @@ class Telnet(Client):
     def __init__(self, address, config={}):
         super(Telnet, self).__init__(address, config)
 
-        # Receive buffer
-        self.buffer = ''
-
         # IAC sequences
         self.IAC = False
         self.IACByte = None
+        self.IACData = []
 
-    def connect(self):
+    def connect(self, sock=None, timeout=None):
         '''
         Establish a connection to the device.
         
+        :param sock: already connected socket to use, optional
+        :param timeout: connect timeout (in seconds), optional
         :raises: :class:`ClientConnectionError`
         '''
-        print 'Connecting to', self.address
-        self.remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.remote.settimeout(self.config.timeout)
         try:
-            self.remote.connect(self.address)
+            if sock is None:
+                self.remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.remote.settimeout(timeout or self.config.timeout)
+                self.remote.connect(self.address)
+            else:
+                self.remote = sock
+            self.remote.settimeout(self.config.timeout)
         except socket.error, e:
             raise ClientConnectionError(e)
         else:
@@ -89,14 +89,16 @@ class Telnet(Client):
         :param timeout: send timeout (in seconds)
         '''
         data = ''.join(args)
-        timeout = kwargs.get('timeout', self.config.timeout)
-        #print '>>>'; self.debug(data)
-        oldtimeout = self.remote.gettimeout()
-        self.remote.settimeout(timeout)
-        try:
-            return self.remote.send(data)
-        finally:
-            self.remote.settimeout(oldtimeout)
+        timeout = kwargs.get('timeout')
+        if timeout is None:
+            return self.remote.sendall(data)
+        else:
+            oldtimeout = self.remote.gettimeout()
+            self.remote.settimeout(timeout)
+            try:
+                return self.remote.sendall(data)
+            finally:
+                self.remote.settimeout(oldtimeout)
 
     def sendline(self, line, timeout=None):
         '''
@@ -114,122 +116,115 @@ class Telnet(Client):
 
         Optionally:
         
-        :param timeout: send timeout (in seconds)
+        :param timeout: read timeout (in seconds), defaults to the timeout
+                        set up during :py:meth:`connect`
         
         :returns: read data
         '''
-        oldtimeout = self.remote.gettimeout()
-        self.remote.settimeout(timeout or self.config.timeout)
-        try:
+        if timeout is None:
             data = self.remote.recv(size)
-        finally:
-            self.remote.settimeout(oldtimeout)
-        #print '<<<'; self.debug(data)
+        else:
+            oldtimeout = self.remote.gettimeout()
+            self.remote.settimeout(timeout)
+            try:
+                data = self.remote.recv(size)
+            finally:
+                self.remote.settimeout(oldtimeout)
         return data
 
-    def readloop(self, callback, timeout=None):
+    def process(self, data):
         '''
-        Keep reading data until the remote is exhausted.
-        
-        :param callback: callback to call once data is received
-        
-        Optionally:
-        
-        :param timeout: send timeout (in seconds)
+        Process a chunk of data. The telnet protocol can send all sorts of
+        control-sequences anywhere in the session, so we look for the
+        ``IAC`` bytes that start them and copy everything in between in bulk.
+        Only the bytes that are part of a sequence are fed to the state
+        machine in :py:meth:`process_IAC`, sequences may be split across
+        chunks.
+
+        All non-sequence items are returned.
         '''
-        timeout = timeout or self.config.timeout
-        chunk = ''
-
-        try:
-            return callback()
-        except ValueError:
-            pass
-
-        # Read socket until there is no data available
-        while True:
-            r, w, e = select.select([self.remote], [], [], timeout)
-            if r:
-                chunk = self.read(timeout=timeout)
-                if chunk:
-                    self.buffer += self.process(chunk)
-                    try:
-                        return callback()
-                    except ValueError:
-                        pass
-                else:
-                    # Socket was readable, but it returned no data so peer
-                    # must have gone away
-                    raise ClientError('Connection closed by peer')
-            else:
-                raise ClientTimeout('Read timeout')
+        output = []
+        offset = 0
+        size = len(data)
+        while offset < size:
+            # If we are working on an IAC sequence
+            if self.IAC:
+                offset = self.process_IAC(data, offset, output)
+                continue
 
-    def readline(self, timeout=None):
-        return self.readloop(self.nextline, timeout)
+            index = data.find(IAC, offset)
+            if index == -1:
+                output.append(data[offset:])
+                break
+            elif index > offset:
+                output.append(data[offset:index])
 
-    def readpart(self, timeout=None):
-        return self.readloop(self.nextpart, timeout)
+            self.IAC = True
+            offset = index + 1
 
-    def readsome(self, timeout=None):
-        try:
-            return self.nextline()
-        except ValueError:
-            pass
-        try:
-            return self.nextpart()
-        except ValueError:
-            pass
-        return self.readpart(timeout)
+        return ''.join(output)
 
-    def process(self, data):
+    def process_IAC(self, data, offset, output):
         '''
-        Process a chunk of data. Here we will perform a byte-by-byte
-        investigation of what crosses the wire, the telnet protocol can
-        send all sorts of control-sequences anywhere in the session.
+        Feed the IAC state machine with the bytes in ``data`` starting at
+        ``offset``, until the current sequence is complete or the data is
+        exhausted. Escaped ``IAC`` bytes are appended to ``output``.
 
-        All non-sequence items are stored in the internal buffer.
+        :returns: offset of the first byte after the sequence
         '''
-        chunk = io.BytesIO()
-        for char in data:
-            # If we are working on an IAC sequence
-            if self.IAC:
-                # and are working on a request state
-                if self.IACByte:
-                    # Check if the next byte is a sub-request
-                    if self.IACByte == SB:
-                        if char == SE:
-                            self.handle_IAC_SB(chunk.getvalue())
-                            chunk = io.BytesIO()
-                            self.IAC = False
-                            self.IACByte = None
-                        else:
-                            chunk.write(char)
-
-                    # Otherwise, this is part of a W/W/D/D sequence
-                    else:
-                        try:
-                            getattr(self, 'handle_IAC_%s' % \
-                                (NAME[self.IACByte]),)(char)
-                        except KeyError:
-                            pass
-                        self.IAC = False
-                        self.IACByte = None
+        # Subnegotiation, collect everything up to and including IAC SE
+        if self.IACByte == SB:
+            size = len(data)
+            while offset < size:
+                index = data.find(SE, offset)
+                if index == -1:
+                    self.IACData.append(data[offset:])
+                    return size
+
+                self.IACData.append(data[offset:index])
+                offset = index + 1
+                chunk = ''.join(self.IACData)
+                if chunk.endswith(IAC):
+                    self.handle_IAC_SB(chunk)
+                    self.IAC = False
+                    self.IACByte = None
+                    self.IACData = []
+                    return offset
                 else:
-                    # Got IAC, read next byte in W/W/D/D sequence
-                    self.IACByte = char
-
-            elif char == IAC:
-                self.IAC = True
+                    # SE without a preceding IAC is payload
+                    self.IACData = [chunk, SE]
+            return offset
+
+        char = data[offset]
+
+        # Got IAC, read the command byte
+        if self.IACByte is None:
+            if char == IAC:
+                # Escaped data byte 255
+                output.append(IAC)
+                self.IAC = False
+            elif char == SB or char in (WILL, WONT, DO, DONT):
+                self.IACByte = char
+                self.IACData = []
             else:
-                chunk.write(char)
+                # Two byte command, nothing to negotiate
+                self.IAC = False
 
-        return chunk.getvalue()
+        # Otherwise, this is the option byte of a W/W/D/D sequence
+        else:
+            handler = getattr(self, 'handle_IAC_%s' % (NAME[self.IACByte],),
+                None)
+            if handler:
+                handler(char)
+            self.IAC = False
+            self.IACByte = None
+
+        return offset + 1
 
     def handle_IAC_SB(self, chunk):
         '''
         Handle subnegotiation.
         '''
-        #print 'IAC SB:'
-        #self.debug(chunk)
         if chunk == TERM_TYPE + ECHO + IAC:
             # TODO: make configurable
             self.send(IAC, SB, TERM_TYPE, IS, "VT100", IAC, SE)
@@ -258,9 +253,6 @@ class Telnet(Client):
             self.send(IAC, DO, ECHO)
             self.send(IAC, WILL, ECHO)
 
-    def debug(self, data):
-        HexDump(step=32).dump(data)
-
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+import errno
+import select
+import socket
+import time
+
+
+def race(addresses, timeout=30, stagger=1.0):
+    '''
+    Connect to several addresses at once, "happy eyeballs" style: the
+    attempts are started in order, ``stagger`` seconds apart or as soon as
+    the previous attempt failed, and the first connection to complete wins.
+    The other attempts are abandoned.
+
+    :param addresses: list of ``(host, port)`` tuples, in order of preference
+    :param timeout: seconds to wait for any connection to complete
+    :param stagger: seconds head start each address gets over the next one
+
+    :returns: ``(index, socket, failed)``, the index of the winning address
+              in ``addresses`` and its connected (blocking) socket, or
+              ``(None, None, failed)`` if no connection completed in time;
+              ``failed`` is the set of indexes of the addresses that refused
+              or otherwise failed
+    '''
+    # Pending attempts by file descriptor, polled instead of selected so
+    # descriptors beyond FD_SETSIZE work
+    pending = {}
+    poller = select.poll()
+    failed = set()
+    started = 0
+    deadline = time.time() + timeout
+    start_next = time.time()
+    try:
+        while True:
+            now = time.time()
+            if started < len(addresses) and (now >= start_next or not pending):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(0)
+                try:
+                    error = sock.connect_ex(addresses[started])
+                except socket.error, e:
+                    # Name resolution failures end up here
+                    error = e.args[0]
+                if error in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    pending[sock.fileno()] = (sock, started)
+                    poller.register(sock, select.POLLOUT | select.POLLERR |
+                        select.POLLHUP)
+                else:
+                    sock.close()
+                    failed.add(started)
+                started += 1
+                start_next = now + stagger
+                continue
+
+            if not pending or now >= deadline:
+                return None, None, failed
+
+            wait = deadline - now
+            if started < len(addresses):
+                wait = min(wait, start_next - now)
+            try:
+                events = poller.poll(max(0, wait) * 1000)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if not fd in pending:
+                    continue
+                sock, index = pending.pop(fd)
+                poller.unregister(fd)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    sock.close()
+                    failed.add(index)
+                else:
+                    sock.setblocking(1)
+                    return index, sock, failed
+    finally:
+        for sock, index in pending.itervalues():
+            sock.close()
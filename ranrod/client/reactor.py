@@ -0,0 +1,260 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+import errno
+import fcntl
+import os
+import select
+import threading
+import time
+from ranrod.client.error import ClientError
+from ranrod.logger import Logger
+
+
+if hasattr(select, 'epoll'):
+    READABLE = select.EPOLLIN | select.EPOLLPRI | select.EPOLLERR | \
+        select.EPOLLHUP
+    INVALID = 0
+else:
+    READABLE = select.POLLIN | select.POLLPRI | select.POLLERR | \
+        select.POLLHUP
+    INVALID = select.POLLNVAL
+
+
+class Reactor(object):
+    '''
+    Single I/O loop for all client sessions of a process.
+
+    Without the reactor, every device thread waits for its own session in
+    :py:func:`select.select`. With the reactor enabled, one thread polls the
+    sessions of all devices using :py:func:`select.epoll` (or
+    :py:func:`select.poll` where epoll is not available), reads the data that
+    arrived, runs the protocol processing (such as the telnet ``IAC``
+    handling) and fills the receive buffers, see
+    :py:meth:`ranrod.client.base.Client.readloop`. Device threads only sleep
+    until their session has new data or their idle timeout expires, and the
+    number of sessions is not limited by the ``FD_SETSIZE`` of
+    :py:func:`select.select`. Models still run as ordinary code on the
+    scheduler threads.
+
+    The thread is started when the first client registers.
+
+    :param enabled: route the reads of new clients through the reactor
+    :param size: maximum number of bytes read at once per client
+    :param slack: seconds a waiting client gives the loop to wake it after
+                  its deadline passed
+    '''
+
+    def __init__(self, enabled=False, size=65536, slack=5.0):
+        self.enabled = enabled
+        self.size = size
+        self.slack = slack
+        self.lock = threading.Lock()
+        # File descriptor to client, and back
+        self.clients = {}
+        self.descriptors = {}
+        # Waiting client to the deadline of its wait
+        self.waiting = {}
+        # Deadline the loop is sleeping until, None if it waits for data
+        self.deadline = None
+        self.epoll = hasattr(select, 'epoll')
+        self.poller = None
+        self.wakeup = None
+        self.thread = None
+
+    def start(self):
+        '''
+        Set up the poller and start the loop, called with :py:attr:`lock`
+        held.
+        '''
+        if self.epoll:
+            self.poller = select.epoll()
+        else:
+            self.poller = select.poll()
+        self.wakeup = os.pipe()
+        # A full pipe already wakes the loop, writers must not block on it
+        flags = fcntl.fcntl(self.wakeup[1], fcntl.F_GETFL)
+        fcntl.fcntl(self.wakeup[1], fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.poller.register(self.wakeup[0], READABLE)
+        self.thread = threading.Thread(target=self.run, name='reactor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def register(self, client):
+        '''
+        Start reading for ``client``.
+        '''
+        fd = client.fileno()
+        with self.lock:
+            if self.thread is None:
+                self.start()
+            self.clients[fd] = client
+            self.descriptors[client] = fd
+            client.reactor = self
+            try:
+                self.poller.register(fd, READABLE)
+            except IOError, e:
+                # A closed client left its descriptor behind, it was reused
+                if e.errno != errno.EEXIST:
+                    raise
+                self.poller.modify(fd, READABLE)
+            self.interrupt()
+
+    def unregister(self, client):
+        '''
+        Stop reading for ``client``, must be called before its remote is
+        closed.
+        '''
+        with self.lock:
+            client.reactor = None
+            fd = self.descriptors.pop(client, None)
+            if fd is not None and self.clients.get(fd) is client:
+                del self.clients[fd]
+                self.forget(fd)
+
+    def forget(self, fd):
+        try:
+            self.poller.unregister(fd)
+        except (IOError, KeyError, ValueError):
+            pass
+
+    def interrupt(self):
+        '''
+        Make the loop poll again, called with :py:attr:`lock` held.
+        '''
+        try:
+            os.write(self.wakeup[1], '.')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, client, timeout):
+        '''
+        Block until the reactor received data for ``client``, or until
+        ``timeout`` seconds passed.
+
+        If the loop misses the deadline by more than :py:attr:`slack`
+        seconds, for example because it died, the wait is treated as
+        expired.
+
+        :returns: ``False`` if the timeout expired
+        '''
+        deadline = time.time() + timeout
+        with self.lock:
+            self.waiting[client] = deadline
+            if self.deadline is None or deadline < self.deadline:
+                self.interrupt()
+        woken = client.ready.wait(max(0, deadline - time.time()) + self.slack)
+        with self.lock:
+            # The loop removes the clients whose wait expired
+            return self.waiting.pop(client, None) is not None and woken
+
+    def poll(self, deadline):
+        if deadline is None:
+            timeout = None
+        else:
+            timeout = max(deadline - time.time(), 0)
+
+        try:
+            if self.epoll:
+                return self.poller.poll(-1 if timeout is None else timeout)
+            else:
+                return self.poller.poll(None if timeout is None else
+                    timeout * 1000)
+        except (IOError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def handle(self, fd, event):
+        client = self.clients.get(fd)
+        if client is None:
+            return
+
+        if event & INVALID:
+            # Closed without being unregistered
+            with self.lock:
+                self.clients.pop(fd, None)
+                self.descriptors.pop(client, None)
+                self.forget(fd)
+            client.error = ClientError('Connection closed')
+            client.ready.set()
+            return
+
+        with client.lock:
+            try:
+                if not client.receive(self.size):
+                    # Remote was readable, but it returned no data so peer
+                    # must have gone away
+                    client.error = ClientError('Connection closed by peer')
+            except Exception, e:
+                client.error = e
+            client.ready.set()
+
+        if client.error is not None:
+            with self.lock:
+                if self.clients.get(fd) is client:
+                    del self.clients[fd]
+                    self.descriptors.pop(client, None)
+                    self.forget(fd)
+
+    def expire(self):
+        '''
+        Wake the clients whose wait passed its deadline without data.
+        '''
+        now = time.time()
+        with self.lock:
+            for client, deadline in self.waiting.items():
+                if deadline <= now and not client.ready.is_set():
+                    del self.waiting[client]
+                    client.ready.set()
+
+    def run(self):
+        log = Logger()
+        while True:
+            try:
+                self.step(log)
+            except Exception, e:
+                log('Reactor loop failed: %s' % (str(e),), level='warning')
+                # Don't spin if the poller keeps failing, the waiting
+                # clients time out on their own
+                time.sleep(1)
+
+    def step(self, log):
+        '''
+        Single iteration of the loop: poll, handle the ready clients and
+        wake the clients whose wait expired.
+        '''
+        with self.lock:
+            if self.waiting:
+                self.deadline = min(self.waiting.itervalues())
+            else:
+                self.deadline = None
+            deadline = self.deadline
+
+        for fd, event in self.poll(deadline):
+            if fd == self.wakeup[0]:
+                os.read(fd, 4096)
+                continue
+            try:
+                self.handle(fd, event)
+            except Exception, e:
+                log('Reactor failed to handle descriptor %d: %s' % (fd,
+                    str(e)), level='warning')
+
+        self.expire()
+
+
+reactor = Reactor()
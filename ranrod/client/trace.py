@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+
+import datetime
+import os
+import threading
+from ranrod.util.hexdump import HexDump
+
+
+class Trace(object):
+    '''
+    Wire trace of a single client, every chunk sent or received is written
+    as a hex dump to a buffered trace file.
+
+    :param filename: trace file, new traces are appended
+    :param buffering: write buffer size (in bytes)
+    '''
+
+    def __init__(self, filename, buffering=65536):
+        self.filename = filename
+        self.output = open(filename, 'ab', buffering)
+        self.hexdump = HexDump(step=32)
+
+    def write(self, direction, data):
+        self.output.write('%s %s %d bytes\n%s' % (datetime.datetime.now(),
+            direction, len(data), self.hexdump.format(data)))
+
+    def close(self):
+        self.output.close()
+
+
+class Tracer(object):
+    '''
+    Decides which clients get traced. Tracing is off unless it is enabled
+    for a protocol (see :py:attr:`protocols`), or in the device
+    configuration using the ``trace`` option.
+
+    Trace files are written to :py:attr:`path`, one per device.
+    '''
+
+    def __init__(self, path='trace', protocols=()):
+        self.path = path
+        self.protocols = set(protocols)
+        self.lock = threading.Lock()
+
+    def enabled(self, client):
+        return client.config.get('trace') or client.name in self.protocols
+
+    def open(self, client):
+        '''
+        Get a :py:class:`Trace` for ``client``, or ``None`` if the client is
+        not to be traced.
+        '''
+        if not self.enabled(client):
+            return None
+
+        name = client.config.get('name')
+        if not name:
+            name = '%s_%d' % client.address
+        filename = os.path.abspath(os.path.join(self.path, name + '.trace'))
+        with self.lock:
+            base = os.path.dirname(filename)
+            if not os.path.isdir(base):
+                os.makedirs(base)
+        return Trace(filename)
+
+
+tracer = Tracer()
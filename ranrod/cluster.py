@@ -0,0 +1,757 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+import Queue
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+import zlib
+from ranrod.config import ConfigMap
+from ranrod.logger import Logger
+from ranrod.metrics import registry
+from ranrod.process import RemoteRepository
+
+
+WORKERS = registry.gauge('ranrod_cluster_workers',
+    'Workers connected to the coordinator')
+JOBS = registry.counter('ranrod_cluster_jobs_total',
+    'Device jobs handled by the coordinator, by result', ['result'])
+
+# Times a device is handed out again after its worker went away
+ATTEMPTS = 3
+
+
+class ClusterError(Exception):
+    pass
+
+
+def decode(value):
+    '''
+    Convert the unicode strings :py:func:`json.loads` gives us back to
+    UTF-8 encoded strings, like the rest of RANROD uses.
+    '''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [decode(item) for item in value]
+    elif isinstance(value, dict):
+        return dict([(decode(key), decode(item))
+            for key, item in value.iteritems()])
+    else:
+        return value
+
+
+def pack(data):
+    return base64.b64encode(zlib.compress(data))
+
+
+def unpack(data):
+    try:
+        return zlib.decompress(base64.b64decode(data))
+    except (TypeError, zlib.error), e:
+        raise ClusterError('Malformed data: %s' % (str(e),))
+
+
+def sign(secret, role, nonce):
+    '''
+    Sign the ``nonce`` of the other side, the ``role`` of the signer is
+    included so a signature can't be reflected back.
+    '''
+    if isinstance(secret, unicode):
+        secret = secret.encode('utf-8')
+    message = '%s:%s' % (role, nonce)
+    return hmac.new(secret, message, hashlib.sha256).hexdigest()
+
+
+def verify(secret, role, nonce, auth):
+    return hmac.compare_digest(sign(secret, role, nonce), str(auth))
+
+
+def loopback(host):
+    '''
+    Check if ``host`` is a loopback address.
+    '''
+    try:
+        return socket.gethostbyname(host).startswith('127.')
+    except socket.error:
+        return False
+
+
+class Channel(object):
+    '''
+    Newline delimited JSON messages over a socket. Every message is a JSON
+    object with a ``type`` key.
+
+    :param sock: connected socket
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.lock = threading.Lock()
+
+    def send(self, kind, **message):
+        message['type'] = kind
+        data = json.dumps(message, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.sock.sendall(data)
+
+    def receive(self):
+        '''
+        Read the next message.
+
+        :returns: message ``dict``, or ``None`` if the peer went away
+        '''
+        line = self.reader.readline()
+        if not line:
+            return None
+        try:
+            message = decode(json.loads(line))
+        except ValueError:
+            raise ClusterError('Malformed message')
+        if not isinstance(message, dict):
+            raise ClusterError('Malformed message')
+        return message
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.reader.close()
+        self.sock.close()
+
+
+class ClusterRepository(RemoteRepository):
+    '''
+    Repository used by a :py:class:`Worker`. Configurations are dumped to
+    temporary files in the working directory and streamed back to the
+    coordinator, which commits them in the central repository.
+
+    :param path: working directory of the worker
+    :param channel: :py:class:`Channel` to the coordinator
+    :param job: job message, with the digests, fingerprints, connect
+                methods and latencies the coordinator knows of the device
+    '''
+
+    def __init__(self, path, channel, job):
+        self.path = path
+        self.config = {}
+        self.channel = channel
+        self.job = job['id']
+        self.lock = threading.RLock()
+        self.logger = Logger()
+        self.counter = itertools.count()
+        self.digests = job.get('digests', {})
+        self.fingerprints = job.get('fingerprints', {})
+        self.methods = job.get('methods', {})
+        self.latencies = job.get('latencies', {})
+
+    def replace(self, filename, temp, digest):
+        if digest == self.digest(filename):
+            os.unlink(temp)
+            return False
+
+        with open(temp, 'rb') as handle:
+            data = handle.read()
+        os.unlink(temp)
+        self.channel.send('replace', id=self.job, filename=filename,
+            digest=digest, data=pack(data))
+        return True
+
+    def update(self, path, message='update', digest=None):
+        self.channel.send('update', id=self.job, filename=path,
+            message=message, digest=digest)
+
+    def set_fingerprint(self, filename, fingerprint):
+        self.channel.send('fingerprint', id=self.job, filename=filename,
+            fingerprint=fingerprint)
+
+    def set_method(self, filename, method):
+        self.channel.send('method', id=self.job, filename=filename,
+            method=method)
+
+    def set_latency(self, filename, latency):
+        self.channel.send('latency', id=self.job, filename=filename,
+            latency=latency)
+
+
+class ClusterStatus(object):
+    '''
+    Status log used by a :py:class:`Worker`, results are sent to the
+    coordinator.
+    '''
+
+    def __init__(self, channel, job):
+        self.channel = channel
+        self.job = job
+
+    def device_up(self, device):
+        self.channel.send('status', id=self.job, result='up', reason='')
+
+    def device_down(self, device, reason=''):
+        if reason:
+            reason = reason.splitlines()[0]
+        self.channel.send('status', id=self.job, result='down',
+            reason=reason)
+
+
+class RemoteWorker(object):
+    '''
+    A worker connected to the :py:class:`Coordinator`.
+    '''
+
+    def __init__(self, channel, name, region=None, slots=1):
+        self.channel = channel
+        self.name = name
+        self.region = region
+        self.slots = max(1, int(slots))
+        # Identifiers of the jobs handed to this worker
+        self.jobs = set()
+
+    def __str__(self):
+        if self.region:
+            return '%s (region %s)' % (self.name, self.region)
+        else:
+            return self.name
+
+
+class Coordinator(object):
+    '''
+    Hands device jobs to remote workers, see :py:class:`Worker`, and
+    commits the configurations they send back in the central repository.
+
+    Workers connect to the coordinator and stay connected between polling
+    cycles. Each worker is handed as many devices as it has collector
+    threads; devices with a ``region`` option only go to workers of that
+    region, other devices go to any worker. Devices of a worker that goes
+    away are handed to the next worker.
+
+    The protocol is newline delimited JSON, see :py:class:`Channel`:
+
+    * coordinator: ``challenge`` with a ``nonce``
+    * worker: ``hello`` with its ``name``, ``region`` and number of
+      ``workers``, the HMAC of the nonce and a ``nonce`` of its own
+    * coordinator: ``welcome`` with the HMAC of the worker's nonce, so the
+      worker knows it is not handing its host to an impostor
+    * coordinator: ``job`` with the device configuration, the model source
+      and the digests, fingerprints, connect methods and latencies we know
+      of the device
+    * worker: ``replace``, ``update``, ``fingerprint``, ``method``,
+      ``latency`` and ``status`` messages while collecting, followed by
+      ``done``
+
+    :param address: ``(host, port)`` to listen on
+    :param repository: :py:class:`ranrod.repository.Repository` instance
+    :param secret: secret shared with the workers, required unless we only
+                   listen on a loopback address
+    :param timeout: seconds a polling cycle may take, devices that were not
+                    collected by then are marked down
+
+    :raises: :class:`ClusterError` if a secret is required
+    '''
+
+    def __init__(self, address, repository, secret=None, timeout=3600):
+        if not secret and not loopback(address[0]):
+            # Workers get the device credentials
+            raise ClusterError('A secret is required to listen on %s' % (
+                address[0],))
+        self.address = address
+        self.repository = repository
+        self.secret = secret
+        self.timeout = timeout
+        self.logger = Logger()
+        self.lock = threading.Condition()
+        self.server = None
+        self.ids = itertools.count(1)
+        # Connected workers
+        self.workers = []
+        # Jobs of the current cycle waiting for a worker, and all unfinished
+        # jobs of the current cycle by identifier
+        self.pending = []
+        self.jobs = {}
+        self.status = None
+        # Files replaced on behalf of the workers, and their digests
+        self.replaced = {}
+        WORKERS.set_function(self.__len__)
+
+    def __len__(self):
+        return len(self.workers)
+
+    def start(self):
+        '''
+        Start accepting workers in a background thread.
+        '''
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(self.address)
+        self.server.listen(64)
+        self.address = self.server.getsockname()
+        thread = threading.Thread(target=self.accept,
+            name='ranrod-coordinator')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def accept(self):
+        server = self.server
+        while True:
+            try:
+                sock, peer = server.accept()
+            except socket.error:
+                # Closed
+                return
+            thread = threading.Thread(target=self.handle, args=(sock, peer),
+                name='ranrod-coordinator-%s:%d' % peer)
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, sock, peer):
+        '''
+        Serve a worker connection.
+        '''
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Don't wait forever for workers that don't say hello
+        sock.settimeout(30)
+        channel = Channel(sock)
+        worker = None
+        try:
+            worker = self.hello(channel, peer)
+            if worker is None:
+                return
+            sock.settimeout(None)
+            while True:
+                message = channel.receive()
+                if message is None:
+                    break
+                self.dispatch(worker, message)
+        except (socket.error, ClusterError), e:
+            self.logger('Worker %s:%d: %s' % (peer[0], peer[1], str(e)),
+                level='warning')
+        finally:
+            channel.close()
+            if worker is not None:
+                self.leave(worker)
+
+    def hello(self, channel, peer):
+        '''
+        Authenticate a worker and add it to the workers.
+
+        :returns: :py:class:`RemoteWorker`, or ``None`` if it was refused
+        '''
+        nonce = os.urandom(16).encode('hex')
+        channel.send('challenge', nonce=nonce)
+        message = channel.receive()
+        if message is None or message.get('type') != 'hello':
+            raise ClusterError('Expected hello')
+
+        if self.secret and not verify(self.secret, 'worker', nonce,
+            message.get('auth')):
+            self.logger('Worker %s:%d refused, bad secret' % peer,
+                level='warning')
+            channel.send('error', reason='Authentication failed')
+            return None
+
+        auth = None
+        if self.secret:
+            auth = sign(self.secret, 'coordinator', str(message.get('nonce')))
+        channel.send('welcome', auth=auth)
+
+        worker = RemoteWorker(channel,
+            message.get('name') or '%s:%d' % peer,
+            region=message.get('region'),
+            slots=message.get('workers', 1))
+        self.logger('Worker %s joined, collecting %d devices at a time' % (
+            worker, worker.slots))
+        with self.lock:
+            self.workers.append(worker)
+            self.assign()
+        return worker
+
+    def leave(self, worker):
+        '''
+        Remove a worker, its unfinished jobs are handed out again.
+        '''
+        self.logger('Worker %s left' % (worker,), level='warning')
+        with self.lock:
+            self.workers.remove(worker)
+            for ident in sorted(worker.jobs, reverse=True):
+                job = self.jobs.get(ident)
+                if job is None:
+                    continue
+                elif job['attempts'] < ATTEMPTS:
+                    self.pending.insert(0, job)
+                else:
+                    self.finish(job, 'down', 'Lost by worker %s' % (worker,))
+            worker.jobs.clear()
+            self.assign()
+
+    def assign(self):
+        '''
+        Hand pending jobs to workers that have collector threads to spare,
+        called with the lock held.
+        '''
+        for worker in self.workers:
+            while len(worker.jobs) < worker.slots:
+                job = self.next_job(worker)
+                if job is None:
+                    break
+                job['attempts'] += 1
+                worker.jobs.add(job['id'])
+                try:
+                    worker.channel.send('job', **job['message'])
+                except socket.error:
+                    # The connection handler will notice and requeue
+                    break
+
+    def next_job(self, worker):
+        for index, job in enumerate(self.pending):
+            region = job['device'].get('region')
+            if not region or region == worker.region:
+                return self.pending.pop(index)
+        return None
+
+    def job(self, device, sources):
+        '''
+        Prepare the job for a device.
+
+        :param sources: model sources read so far, by path
+        '''
+        if device.model not in sources:
+            with open(device.model) as handle:
+                sources[device.model] = handle.read()
+
+        filename = os.path.join('config', device.name)
+        name = self.repository.name(filename)
+        config = dict(device.config)
+        config['model'] = os.path.basename(device.model)
+        ident = self.ids.next()
+        message = dict(
+            id = ident,
+            device = config,
+            model = sources[device.model],
+            digests = {},
+            fingerprints = {},
+            methods = {},
+            latencies = {},
+        )
+        digest = self.repository.digest(filename)
+        if digest:
+            message['digests'][name] = digest
+        fingerprint = self.repository.fingerprint(filename)
+        if fingerprint:
+            message['fingerprints'][name] = fingerprint
+        method = self.repository.method(filename)
+        if method:
+            message['methods'][name] = method
+        latency = self.repository.load_latencies().get(name)
+        if latency:
+            message['latencies'][name] = latency
+
+        return dict(
+            id = ident,
+            device = device,
+            filename = filename,
+            message = message,
+            attempts = 0,
+        )
+
+    def run(self, devices, status):
+        '''
+        Hand out ``devices`` and block until all are collected, or until the
+        cycle timed out.
+
+        :param devices: list of device configurations
+        :param status: :py:class:`ranrod.status.Status` instance
+        '''
+        with self.lock:
+            self.status = status
+            self.replaced = {}
+            sources = {}
+            for device in devices:
+                try:
+                    job = self.job(device, sources)
+                except IOError, e:
+                    status.device_down(device, reason=str(e))
+                    continue
+                self.jobs[job['id']] = job
+                self.pending.append(job)
+
+            self.assign()
+            deadline = time.time() + self.timeout
+            while self.jobs:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.lock.wait(min(remaining, 1.0))
+
+            for job in self.jobs.values():
+                self.finish(job, 'down', 'Not collected by any worker')
+            del self.pending[:]
+            for worker in self.workers:
+                worker.jobs.clear()
+
+    def finish(self, job, result, reason=''):
+        '''
+        Record the result of a job, called with the lock held.
+        '''
+        del self.jobs[job['id']]
+        JOBS.labels(result).inc()
+        if result == 'up':
+            self.status.device_up(job['device'])
+        else:
+            self.status.device_down(job['device'], reason=reason)
+        self.lock.notify_all()
+
+    def dispatch(self, worker, message):
+        '''
+        Handle a message from a worker.
+        '''
+        kind = message.get('type')
+        with self.lock:
+            job = self.jobs.get(message.get('id'))
+        if job is None:
+            # From an earlier cycle that timed out, or not ours at all
+            return
+
+        filename = message.get('filename')
+        if filename is not None and filename != job['filename']:
+            raise ClusterError('Job %d may not write %s' % (job['id'],
+                filename))
+
+        if kind in ('replace', 'update') and filename is None:
+            raise ClusterError('Job %d sent %s without a file name' % (
+                job['id'], kind))
+
+        if kind == 'replace':
+            data = unpack(message.get('data', ''))
+            # Don't trust the digest of the worker, it ends up in the
+            # repository and decides if future runs commit the file
+            digest = hashlib.sha1(data).hexdigest()
+            temp = self.repository.open_temp(filename)
+            temp.write(data)
+            temp.close()
+            if self.repository.replace(filename, temp.name, digest):
+                with self.lock:
+                    self.replaced[filename] = digest
+
+        elif kind == 'update':
+            with self.lock:
+                digest = self.replaced.pop(filename, None)
+            # The file may have turned out to be unchanged after all
+            if digest is not None:
+                self.repository.update(filename,
+                    message=message.get('message', 'update'),
+                    digest=digest)
+
+        elif kind == 'fingerprint':
+            self.repository.set_fingerprint(filename,
+                message.get('fingerprint'))
+
+        elif kind == 'method':
+            self.repository.set_method(filename, message.get('method'))
+
+        elif kind == 'latency':
+            try:
+                latency = dict([(str(key), float(seconds))
+                    for key, seconds in message.get('latency').iteritems()])
+            except (AttributeError, TypeError, ValueError):
+                raise ClusterError('Malformed latency')
+            self.repository.set_latency(filename, latency)
+
+        elif kind == 'status':
+            job['result'] = (message.get('result'), message.get('reason'))
+
+        elif kind == 'done':
+            with self.lock:
+                worker.jobs.discard(job['id'])
+                if job['id'] in self.jobs:
+                    result, reason = job.get('result',
+                        ('down', 'No status from worker %s' % (worker,)))
+                    self.finish(job, result, reason)
+                self.assign()
+
+    def close(self):
+        '''
+        Stop accepting workers and disconnect the current ones.
+        '''
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        with self.lock:
+            workers = self.workers[:]
+        for worker in workers:
+            worker.channel.close()
+
+
+class Worker(object):
+    '''
+    Collects devices handed out by a :py:class:`Coordinator`. The worker
+    keeps (re)connecting to the coordinator until it is interrupted.
+
+    :param address: ``(host, port)`` of the coordinator
+    :param collect: function to collect a device, called as
+                    ``collect(device, repository, status)``
+    :param path: working directory, for temporary files and models
+    :param name: name of the worker, defaults to the host name
+    :param region: region of the devices this worker can reach
+    :param workers: number of devices to collect concurrently
+    :param secret: secret shared with the coordinator, required unless the
+                   coordinator is on a loopback address
+    :param retry: seconds between connection attempts
+
+    :raises: :class:`ClusterError` if a secret is required
+    '''
+
+    def __init__(self, address, collect, path='work', name=None, region=None,
+        workers=1, secret=None, retry=5):
+        if not secret and not loopback(address[0]):
+            # The coordinator sends us models to run
+            raise ClusterError('A secret is required to work for %s' % (
+                address[0],))
+        self.address = address
+        self.collect = collect
+        self.path = os.path.abspath(path)
+        self.name = name or socket.gethostname()
+        self.region = region
+        self.workers = max(1, int(workers or 1))
+        self.secret = secret
+        self.retry = retry
+        self.lock = threading.Lock()
+        self.logger = Logger()
+
+    def run(self):
+        while True:
+            try:
+                sock = socket.create_connection(self.address, 30)
+                sock.settimeout(None)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except socket.error, e:
+                self.logger('Coordinator %s:%d unreachable: %s' % (
+                    self.address[0], self.address[1], str(e)),
+                    level='warning')
+            else:
+                self.logger('Connected to coordinator %s:%d' % self.address)
+                try:
+                    self.serve(Channel(sock))
+                except (socket.error, ClusterError), e:
+                    self.logger('Coordinator connection lost: %s' % (str(e),),
+                        level='warning')
+                else:
+                    self.logger('Coordinator closed the connection',
+                        level='warning')
+            time.sleep(self.retry)
+
+    def serve(self, channel):
+        '''
+        Take jobs from the coordinator until it goes away.
+        '''
+        message = channel.receive()
+        if message is None or message.get('type') != 'challenge':
+            channel.close()
+            raise ClusterError('Expected challenge')
+
+        auth = None
+        nonce = os.urandom(16).encode('hex')
+        if self.secret:
+            auth = sign(self.secret, 'worker', str(message.get('nonce')))
+        channel.send('hello', name=self.name, region=self.region,
+            workers=self.workers, auth=auth, nonce=nonce)
+
+        # Don't take jobs from a coordinator that does not know the secret
+        message = channel.receive()
+        if message is None:
+            channel.close()
+            raise ClusterError('Coordinator closed the connection')
+        elif message.get('type') == 'error':
+            channel.close()
+            raise ClusterError(message.get('reason'))
+        elif message.get('type') != 'welcome':
+            channel.close()
+            raise ClusterError('Expected welcome')
+        elif self.secret and not verify(self.secret, 'coordinator', nonce,
+            message.get('auth')):
+            channel.close()
+            raise ClusterError('Coordinator failed to authenticate')
+
+        jobs = Queue.Queue()
+        threads = []
+        for x in xrange(self.workers):
+            thread = threading.Thread(target=self.worker,
+                args=(channel, jobs), name='ranrod-worker-%d' % (x,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            while True:
+                message = channel.receive()
+                if message is None:
+                    break
+                elif message.get('type') == 'job':
+                    jobs.put(message)
+                elif message.get('type') == 'error':
+                    raise ClusterError(message.get('reason'))
+        finally:
+            # Running jobs are handed out again by the coordinator
+            for thread in threads:
+                jobs.put(None)
+            channel.close()
+
+    def worker(self, channel, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            try:
+                self.job(channel, job)
+            except socket.error, e:
+                self.logger('Job %d: %s' % (job['id'], str(e)),
+                    level='warning')
+
+    def job(self, channel, job):
+        device = ConfigMap(job['device'])
+        device.model = self.model(device.model, job['model'])
+        repository = ClusterRepository(self.path, channel, job)
+        status = ClusterStatus(channel, job['id'])
+        try:
+            self.collect(device, repository, status)
+        finally:
+            channel.send('done', id=job['id'])
+
+    def model(self, name, source):
+        '''
+        Store a model received from the coordinator.
+
+        :param name: name of the model
+        :param source: model source
+        :returns: path to the model
+        '''
+        path = os.path.join(self.path, 'models',
+            hashlib.sha1(source).hexdigest(), os.path.basename(name))
+        with self.lock:
+            if not os.path.isfile(path):
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path + '.tmp', 'w') as handle:
+                    handle.write(source)
+                os.rename(path + '.tmp', path)
+        return path
@@ -23,10 +23,11 @@ class ConfigMap(object):
     '''
 
     def __init__(self, config={}):
+        # Bypass __setattr__, it stores attributes in the map itself
         if isinstance(config, ConfigMap):
-            self.config = config.config
+            object.__setattr__(self, 'config', config.config)
         else:
-            self.config = config
+            object.__setattr__(self, 'config', config)
 
     def __contains__(self, item):
         if hasattr(super(ConfigMap, self), 'config'):
@@ -14,14 +14,32 @@ __license__   = 'MIT'
 
 
 import datetime
+import hashlib
 import os
 import parser
 import re
+import time
 import traceback
 from ranrod.config import ConfigMap
 from ranrod.client import ClientError
+from ranrod.client.error import ClientRefused, ClientTimeout
+from ranrod.device.cache import models
 from ranrod.device.constants import *
+from ranrod.device.error import DeviceError, DeviceConfigError, \
+    DeviceUnchanged
+from ranrod.device.filter import Pipeline
+from ranrod.latency import Latency
 from ranrod.logger import Logger
+from ranrod.metrics import registry
+from ranrod.timing import timings
+
+
+DEVICES_ACTIVE = registry.gauge('ranrod_devices_active',
+    'Devices being collected')
+DEVICES = registry.counter('ranrod_devices_total',
+    'Devices collected, by result', ['result'])
+COMMANDS = registry.counter('ranrod_commands_total',
+    'Commands run on devices')
 
 
 class DeviceDumper(object):
@@ -31,30 +49,46 @@ class DeviceDumper(object):
 
     def __enter__(self):
         self.device.cmd_log('Device log starting')
-        filename = os.path.join('config', self.device.name)
-        self.log = self.device.repository.open(filename, 'w')
+        self.filename = os.path.join('config', self.device.name)
+        self.log = self.device.repository.open_temp(self.filename)
+        self.digest = hashlib.sha1()
+        self.size = 0
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        repository = self.device.repository
+
         if exc_type is None:
-            # The while-loop exited normally, add file and commit changes
-            info = dict(message='update', path=self.log.name)
-            self.device.repository.file_add(**info)
-            self.device.repository.file_commit(**info)
+            # The while-loop exited normally, add file and commit changes if
+            # the configuration changed
+            digest = self.digest.hexdigest()
+            with timings.measure('dump', self.filename) as measure:
+                measure.size = self.size
+                if repository.replace(self.filename, self.log.name, digest):
+                    repository.update(self.filename, message='update',
+                        digest=digest)
+                else:
+                    self.device.cmd_log('Configuration unchanged')
+        elif issubclass(exc_type, DeviceUnchanged):
+            # Collection skipped, keep the previous configuration
+            os.unlink(self.log.name)
+
         else:
-            # The while-loop threw an error
+            # The while-loop threw an error, keep the previous configuration
+            os.unlink(self.log.name)
             self.device.cmd_log('Fatal error: %s %s' % \
                 (exc_type.__name__, exc_value))
             for line in traceback.format_list(traceback.extract_tb(tb)):
                 self.device.cmd_log(line)
 
-        self.close()
-
     def close(self):
         self.log.close()
         self.device.cmd_log('Device log closing')
 
     def write(self, data):
+        self.size += len(data)
+        self.digest.update(data)
         self.log.write(data)
 
 
@@ -66,9 +100,12 @@ def record(device):
             else:
                 output = func
 
-            # Get rid of funky line endings
-            output = '\n'.join(map(lambda s: s.strip('\r'), output.split('\n')))
-            log.write(self.filtered(output))
+            with timings.measure('record') as measure:
+                measure.size = len(output)
+                # Get rid of funky line endings
+                output = '\n'.join(map(lambda s: s.strip('\r'),
+                    output.split('\n')))
+                log.write(self.filtered(output))
 
             # Wait for prompt
             if wait:
@@ -86,24 +123,21 @@ def record(device):
                 pattern = re.compile(pattern)
             device.ignores.append(pattern)
 
+        @staticmethod
+        def filter_line(line):
+            '''
+            Run a single line through the ignores and filters, returns
+            ``None`` if the line is to be ignored.
+            '''
+            return device.pipeline()(line)
+
         def filtered(self, data):
+            pipeline = device.pipeline()
             output = []
             for line in data.split('\n'):
-                skip = False
-                for pattern in device.ignores:
-                    if pattern.search(line):
-                        skip = True
-                        break
-
-                if skip:
-                    continue
-
-                for pattern, replace in device.filters:
-                    for match in pattern.finditer(line):
-                        for item in match.groups():
-                            line = line.replace(item, replace or '<removed>', 1)
-
-                output.append(line)
+                line = pipeline(line)
+                if line is not None:
+                    output.append(line)
 
             return '\n'.join(output)
 
@@ -113,12 +147,48 @@ def record(device):
 def connect(device):
     class DeviceConnect(object):
         def __enter__(self):
-            print 'Connect', device.config.address
+            # Resume a pooled session, if we have one
+            if device.pool is not None:
+                session = device.pool.checkout(device.name,
+                    device.config.address)
+                if session is not None:
+                    if device.sock is not None:
+                        device.sock.close()
+                        device.sock = None
+                    device.remote = session.client
+                    device.resumed = True
+                    device.logged_in = True
+                    device.logger = device.logger.bind(
+                        protocol=device.remote.name)
+                    device.cmd_log('Resumed session to %s' % (device.remote,))
+                    return
+
+            device.logger('Connecting to %s:%d' % device.config.address,
+                level='debug')
             device.remote = device.factory(device.config.address, device.config)
-            device.remote.connect()
+            device.logger = device.logger.bind(protocol=device.remote.name)
+            # The client owns the socket from here on
+            sock, device.sock = device.sock, None
+            with timings.measure('connect', str(device.remote)) as measure:
+                try:
+                    device.remote.connect(sock,
+                        timeout=device.latency.timeout('connect'))
+                except Exception:
+                    # __exit__ does not run if we fail here, so don't leak
+                    # the trace file
+                    if device.remote.trace is not None:
+                        device.remote.trace.close()
+                    raise
+            device.latency.observe('connect', time.time() - measure.started)
             device.cmd_log('Connected to %s' % (device.remote,))
 
         def __exit__(self, exc_type, exc_value, tb):
+            device.resumed = False
+            clean = exc_type is None or issubclass(exc_type, DeviceUnchanged)
+            if device.pool is not None and clean:
+                device.pool.checkin(device.name, device.remote, device.prompt)
+                return
+
             try:
                 device.remote.close()
                 device.cmd_log('Graceful shutdown succeeded')
@@ -149,19 +219,32 @@ class DeviceConfig(ConfigMap):
 
 
 class Device(object):
-    def __init__(self, config, name, factory, repository):
+    def __init__(self, config, name, factory, repository, pool=None):
         self.config = DeviceConfig(config, False)
         self.name = name
         self.factory = factory
         self.repository = repository
+        # Session pool, see ranrod.client.pool.Pool
+        self.pool = pool
+        self.resumed = False
+        self.logged_in = False
+        # Change fingerprint, see cmd_fingerprint
+        self.fingerprint = None
+        # Socket connected by ranrod.client.race, if any
+        self.sock = None
+        # Latencies of this and earlier runs, see ranrod.latency.Latency
+        self.latency = Latency(self.config,
+            repository.latency(os.path.join('config', name)))
 
         self.environ = {}
         self.capture = {}
         self.filters = []
         self.ignores = []
         self.expects = {}
+        self.compiled = (None, None)
         self.prompt = ''
-        self.logger = Logger()
+        self.logger = Logger(device=name)
+        self.logger.start()
         self.record = record(self)
         self.remote = None
 
@@ -176,21 +259,49 @@ class Device(object):
         This reads the RANROD device description file and evaluates the
         script within. Some day this should be refactored to an AST-type
         of parser, but for now this give us the flexibility we need.
+
+        Compiled scripts are shared between devices, see
+        :py:class:`ranrod.device.cache.ModelCache`.
         '''
-        data = []
-        # Make sure we have the with-statement available
-        data.append('from __future__ import with_statement')
-        # Append the file data
-        data.append(file(filename).read())
-        # Compile!
-        code = compile('\n'.join(data), filename, 'exec')
+        # Compile, or get the compiled script from the cache
+        code = models.compile(filename)
         # Reset environment
         self.reset()
+        DEVICES_ACTIVE.inc()
+        filename = os.path.join('config', self.name)
         try:
             eval(code, self.environ, self.capture)
+        except DeviceUnchanged:
+            DEVICES.labels('unchanged').inc()
+            self.repository.set_latency(filename, self.latency.values())
+        except ClientTimeout:
+            DEVICES.labels('error').inc()
+            # Allow more time next run
+            self.latency.expired()
+            self.repository.set_latency(filename, self.latency.values())
+            raise
         except Exception, e:
             # TODO: Handle exception in script
+            DEVICES.labels('error').inc()
             raise
+        else:
+            DEVICES.labels('ok').inc()
+            # Only remember the fingerprint once the collection succeeded
+            if self.fingerprint is not None:
+                self.repository.set_fingerprint(filename, self.fingerprint)
+            self.repository.set_latency(filename, self.latency.values())
+        finally:
+            DEVICES_ACTIVE.dec()
+
+    def pipeline(self):
+        '''
+        Get the compiled :py:class:`ranrod.device.filter.Pipeline` for the
+        current ignores and filters, it is rebuilt when rules are added.
+        '''
+        key = (len(self.ignores), len(self.filters))
+        if self.compiled[0] != key:
+            self.compiled = (key, Pipeline(self.ignores, self.filters))
+        return self.compiled[1]
 
     def reset(self):
         '''
@@ -207,9 +318,11 @@ class Device(object):
             'header':  self.cmd_header,
             'capture': self.cmd_capture,
             'command': self.cmd_command,
+            'commands': self.cmd_commands,
             'connect': self.cmd_connect,
             'record':  self.cmd_record,
             'filter':  self.cmd_filter,
+            'fingerprint': self.cmd_fingerprint,
             'ignore':  self.cmd_ignore,
             'expect':  self.cmd_expect,
             'pattern': self.cmd_pattern,
@@ -239,7 +352,7 @@ class Device(object):
         # Register hook
         self.cmd_expect(pattern, capture)
 
-    def cmd_command(self, line):
+    def cmd_command(self, line, output=None):
         '''
         Execute a command and wait for the device to return to the prompt.
         Will return the output of the command, so one can re-use it in a
@@ -247,22 +360,125 @@ class Device(object):
 
             >>> record(output, command('uptime'))
 
+        For large outputs, pass the :func:`dumper` instance as ``output``;
+        the output is then filtered and written line by line as it arrives,
+        without keeping it in memory::
+
+            >>> command('show running-config', output)
+
         '''
         if self.remote:
+            self.resumed = False
             self.cmd_log('command: %s' % (line.strip(),))
-            self.sendline(line)
-            output = self.remote.wait_for(self.prompt, callbacks=self.expects)
+            COMMANDS.inc()
+            key = 'command %s' % (line.strip(),)
+            timeout = self.latency.timeout(key)
+            streaming = output is not None
+            self.remote.slowest = 0.0
+            with timings.measure('command', line) as measure:
+                self.sendline(line)
+                if streaming:
+                    measure.size = self.stream(line, output, timeout)
+                else:
+                    output = self.remote.wait_for(self.prompt,
+                        timeout=timeout, callbacks=self.expects)
+                    measure.size = len(output)
+            self.latency.observe(key, self.remote.slowest)
+            if streaming:
+                return
+
             s = 0
             if output.startswith(line):
                 # Device did not respect our echo off request
                 s = 1
-            output = '\n'.join(map(lambda s: s.strip('\r'), output.split('\n')[s:-1]))
-
-            output = '\n'.join(['%', '%% command: %s' % (line, ), '%', output, ''])
-            return output
+            return self.output(line, output.split('\n')[s:-1])
         else:
             raise DeviceError('Remote not connected.')
 
+    def cmd_commands(self, *lines):
+        '''
+        Execute several commands, returns a list with the output of each
+        command, as :py:meth:`cmd_command` would::
+
+            >>> version, config = commands('show version', 'show config')
+
+        If the client supports it (SSH), the commands run in parallel on
+        separate exec channels. Otherwise, or if the device refuses exec
+        channels, or if ``exec`` is disabled in the device configuration,
+        the commands run one after another in the interactive session. A
+        command that times out is an error, like in :py:meth:`cmd_command`.
+        '''
+        if not self.remote:
+            raise DeviceError('Remote not connected.')
+
+        if self.remote.channels and self.config.get('exec', True):
+            self.cmd_log('commands: %s' % (', '.join(lines),))
+            try:
+                with timings.measure('commands', ', '.join(lines)) as measure:
+                    outputs = self.remote.execute(lines,
+                        timeout=self.latency.timeout('gap'))
+                    measure.size = sum(map(len, outputs))
+            except ClientRefused, e:
+                # Don't try again for this session, a timeout or lost
+                # connection is not a reason to fall back to the shell
+                self.remote.channels = False
+                self.cmd_log('Exec channels unavailable: %s' % (str(e),))
+            else:
+                result = []
+                for line, output in zip(lines, outputs):
+                    # Output ends with a newline instead of a prompt
+                    if output.endswith('\n'):
+                        output = output[:-1]
+                    result.append(self.output(line, output.split('\n')))
+                return result
+
+        return [self.cmd_command(line) for line in lines]
+
+    def output(self, command, lines):
+        '''
+        Format the output ``lines`` of ``command`` for recording.
+        '''
+        # Get rid of funky line endings
+        output = '\n'.join(map(lambda s: s.strip('\r'), lines))
+        return '\n'.join(['%', '%% command: %s' % (command, ), '%', output,
+            ''])
+
+    def stream(self, command, output, timeout=None):
+        '''
+        Wait for the device to return to the prompt after sending
+        ``command``, recording its output to ``output`` line by line. The
+        result is the same as recording the output of :py:meth:`cmd_command`.
+
+        :param timeout: idle timeout (in seconds)
+
+        :returns: number of bytes received
+        '''
+        filter_line = self.pipeline()
+        state = dict(first=True, size=0)
+
+        def write(data):
+            state['size'] += len(data)
+            # Get rid of funky line endings
+            data = data.strip('\r\n')
+            if state['first']:
+                state['first'] = False
+                if data.startswith(command):
+                    # Device did not respect our echo off request
+                    return
+
+            data = filter_line(data)
+            if data is not None:
+                output.write(data + '\n')
+
+        for data in ['%', '%% command: %s' % (command,), '%']:
+            data = filter_line(data)
+            if data is not None:
+                output.write(data + '\n')
+
+        tail = self.remote.wait_for(self.prompt, timeout=timeout,
+            callbacks=self.expects, output=write)
+        return state['size'] + len(tail)
+
     def cmd_connect(self, device):
         return connect(device)
 
@@ -323,6 +539,46 @@ class Device(object):
         '''
         return self.record.ignore(self.cmd_pattern(pattern, flags))
 
+    def cmd_fingerprint(self, line, pattern=None, flags='m'):
+        '''
+        Run a cheap command whose output changes whenever the configuration
+        of the device changes, such as a configuration change counter or
+        commit timestamp::
+
+            >>> fingerprint('show archive', r'Last change: (.*)')
+
+        If a ``pattern`` is given, only the first group (or the whole match)
+        is used, otherwise the output is used after running it through the
+        ignores and filters. If the fingerprint equals the one seen during
+        the last successful collection, the rest of the model is skipped;
+        devices configured with ``full = yes`` are always collected.
+        '''
+        output = self.cmd_command(line)
+        if pattern is not None:
+            match = self.cmd_pattern(pattern, flags).search(output)
+            if match is None:
+                self.cmd_log('Fingerprint not found in "%s" output' % (line,))
+                return
+            if match.re.groups:
+                # A first group that did not participate counts as empty
+                output = match.group(1) or ''
+            else:
+                output = match.group(0)
+        else:
+            filter_line = self.pipeline()
+            output = '\n'.join([data for data in map(filter_line,
+                output.split('\n')) if data is not None])
+
+        if type(output) == unicode:
+            output = output.encode('utf-8')
+        self.fingerprint = hashlib.sha1(output).hexdigest()
+        filename = os.path.join('config', self.name)
+        if self.config.get('full'):
+            return
+        elif self.repository.fingerprint(filename) == self.fingerprint:
+            self.cmd_log('Fingerprint unchanged, skipping collection')
+            raise DeviceUnchanged('Fingerprint unchanged')
+
     def cmd_header(self, remark, comment='%'):
         return '%s\r\n%s RANROD - Device configuration for %s\r\n%s\r\n' % \
             (comment, comment, remark, comment)
@@ -360,6 +616,9 @@ class Device(object):
         While waiting for the prompt, all possible expected strings that
         were previously defined with the ``expect`` command will be
         evaluated.
+
+        A resumed session from the pool is known to be at the prompt already,
+        so the first wait after resuming returns immediately.
         '''
         # Set prompt pattern
         if pattern:
@@ -370,8 +629,19 @@ class Device(object):
 
         # Wait for prompt
         else:
-            if self.remote:
-                self.remote.wait_for(self.prompt, callbacks=self.expects)
+            if self.resumed:
+                self.resumed = False
+            elif self.remote:
+                # The first prompt is the end of the login
+                kind = self.logged_in and 'prompt' or 'login'
+                key = self.logged_in and 'gap' or 'login'
+                self.remote.slowest = 0.0
+                with timings.measure(kind):
+                    self.remote.wait_for(self.prompt,
+                        timeout=self.latency.timeout(key),
+                        callbacks=self.expects)
+                self.latency.observe(key, self.remote.slowest)
+                self.logged_in = True
             else:
                 raise DeviceError('Remote not connected.')
 
@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+
+__all__ = ['ModelCache', 'models']
+
+
+import hashlib
+import imp
+import marshal
+import os
+import threading
+
+
+class ModelCache(object):
+    '''
+    Process-wide cache of compiled model scripts.
+
+    Compiled code is kept in memory, keyed by the model path and validated
+    against the modification time and size of the model file. Optionally
+    the compiled code is also stored on disk in the ``store`` directory,
+    validated against a hash of the model source, so fresh processes can
+    skip compiling as well.
+
+    :param store: directory to store compiled models in (optional)
+    '''
+
+    # Prepended to every model script
+    header = 'from __future__ import with_statement\n'
+
+    def __init__(self, store=None):
+        self.store = store
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def __contains__(self, filename):
+        return os.path.abspath(filename) in self.cache
+
+    def clear(self):
+        '''
+        Forget all compiled models and reset the counters.
+        '''
+        with self.lock:
+            self.cache.clear()
+            self.hits = self.misses = self.loads = 0
+
+    def compile(self, filename):
+        '''
+        Get the code object for a model script, compiles the model if we
+        don't have a valid copy in memory or on disk.
+
+        :param filename: path to the model script
+        '''
+        filename = os.path.abspath(filename)
+        info = os.stat(filename)
+        stamp = (info.st_mtime, info.st_size)
+
+        with self.lock:
+            cached = self.cache.get(filename)
+            if cached and cached[0] == stamp:
+                self.hits += 1
+                return cached[1]
+
+        source = file(filename).read()
+        digest = hashlib.sha1(source).hexdigest()
+        code = self.load(filename, digest)
+        if code is None:
+            code = compile(self.header + source, filename, 'exec')
+            self.save(filename, digest, code)
+            loaded = False
+        else:
+            loaded = True
+
+        with self.lock:
+            self.cache[filename] = (stamp, code)
+            if loaded:
+                self.loads += 1
+            else:
+                self.misses += 1
+        return code
+
+    def path(self, filename):
+        '''
+        Location of the compiled model in the on-disk store, models with
+        the same name in different directories get their own file.
+        '''
+        filename = os.path.abspath(filename)
+        return os.path.join(self.store, '%s-%s.rrc' % (
+            hashlib.sha1(filename).hexdigest()[:16],
+            os.path.basename(filename)))
+
+    def load(self, filename, digest):
+        '''
+        Load compiled code from the on-disk store, if it was compiled from
+        the same source with the same Python version.
+        '''
+        if not self.store:
+            return None
+
+        try:
+            with open(self.path(filename), 'rb') as handle:
+                if handle.read(4) != imp.get_magic():
+                    return None
+                if handle.read(40) != digest:
+                    return None
+                return marshal.load(handle)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+    def save(self, filename, digest, code):
+        '''
+        Save compiled code to the on-disk store, failures are not fatal.
+        '''
+        if not self.store:
+            return
+
+        path = self.path(filename)
+        temp = '%s.%d.%d' % (path, os.getpid(),
+            threading.current_thread().ident)
+        try:
+            if not os.path.isdir(self.store):
+                os.makedirs(self.store)
+            with open(temp, 'wb') as handle:
+                handle.write(imp.get_magic())
+                handle.write(digest)
+                marshal.dump(code, handle)
+            os.rename(temp, path)
+        except (IOError, OSError):
+            if os.path.exists(temp):
+                os.unlink(temp)
+
+    def stats(self):
+        '''
+        Cache hit/miss counters.
+        '''
+        with self.lock:
+            return dict(
+                hits   = self.hits,
+                loads  = self.loads,
+                misses = self.misses,
+                models = len(self.cache),
+            )
+
+
+# Process-wide model cache
+models = ModelCache()
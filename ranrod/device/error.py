@@ -24,3 +24,11 @@ class DeviceConfigError(DeviceError):
     pass
 
 
+class DeviceUnchanged(DeviceError):
+    '''
+    Raised by the ``fingerprint`` model function to skip the collection of
+    a device whose configuration did not change.
+    '''
+    pass
+
+
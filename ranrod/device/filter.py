@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+
+__all__ = ['Pipeline']
+
+
+import re
+import sre_constants
+import sre_parse
+from ranrod.client.expect import BACKREF_RE
+
+
+def literal(pattern):
+    '''
+    Find the longest literal string that must appear in any text matched by
+    the compiled regular expression ``pattern``, returns ``None`` if there
+    is no such literal (or if we can't tell).
+    '''
+    if pattern.flags & re.IGNORECASE:
+        return None
+
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except (sre_constants.error, TypeError):
+        return None
+
+    best = []
+    run = []
+    for op, av in list(parsed) + [(None, None)]:
+        if op == sre_constants.LITERAL and av < 0x80:
+            run.append(chr(av))
+        else:
+            if len(run) > len(best):
+                best = run
+            run = []
+
+    if best:
+        return ''.join(best)
+    else:
+        return None
+
+
+class Pipeline(object):
+    '''
+    Compiled line filter pipeline, built from the ``ignore`` and ``filter``
+    rules of a model.
+
+    * The ignores are merged into a single alternation per set of flags, so
+      each line is scanned once to decide if it is to be ignored.
+    * Every filter is tagged with a literal string that must be present in
+      the line for the filter to match (if there is one), lines that don't
+      contain the literal skip the filter without running the expression.
+    * Matched groups are replaced by rebuilding the line from the match
+      spans, instead of searching for the matched text again.
+
+    Unlike the ignores, the filters are not merged into one alternation:
+    every filter sees the line as changed by the filters before it, and
+    filters may match overlapping text, where an alternation would only
+    apply the first filter matching at a position. Python's regular
+    expression engine tries every branch of an alternation at every
+    position anyway, so merging would not save any work.
+
+    :param ignores: list of compiled regular expressions
+    :param filters: list of tuples of a compiled regular expression and the
+                    replacement string (``None`` for ``<removed>``)
+    '''
+
+    def __init__(self, ignores=[], filters=[]):
+        self.ignores = []
+        grouped = {}
+        for pattern in ignores:
+            if BACKREF_RE.search(pattern.pattern):
+                self.ignores.append(pattern)
+            else:
+                grouped.setdefault(pattern.flags, []).append(pattern)
+
+        for flags, patterns in grouped.iteritems():
+            if len(patterns) == 1:
+                self.ignores.extend(patterns)
+                continue
+
+            try:
+                self.ignores.append(re.compile('|'.join(['(?:%s)' % \
+                    (pattern.pattern,) for pattern in patterns]), flags))
+            except (re.error, AssertionError, OverflowError):
+                # For example duplicate group names, or too many groups
+                self.ignores.extend(patterns)
+
+        self.filters = []
+        for pattern, replace in filters:
+            if not pattern.groups:
+                # Only groups are replaced, this filter never changes a line
+                continue
+            self.filters.append((literal(pattern), pattern,
+                replace or '<removed>'))
+
+    def __call__(self, line):
+        '''
+        Run a single line through the pipeline, returns ``None`` if the line
+        is to be ignored.
+        '''
+        for pattern in self.ignores:
+            if pattern.search(line):
+                return None
+
+        for required, pattern, replace in self.filters:
+            if required is None or required in line:
+                line = self.substitute(pattern, replace, line)
+
+        return line
+
+    @staticmethod
+    def substitute(pattern, replace, line):
+        '''
+        Replace all groups matched by ``pattern`` in ``line`` with the
+        ``replace`` string.
+        '''
+        parts = []
+        last = 0
+        for match in pattern.finditer(line):
+            for group in xrange(1, pattern.groups + 1):
+                start, end = match.span(group)
+                # Skip groups that did not participate, or that are nested
+                # in a group we replaced already
+                if start == -1 or start < last:
+                    continue
+                parts.append(line[last:start])
+                parts.append(replace)
+                last = end
+
+        if parts:
+            parts.append(line[last:])
+            return ''.join(parts)
+        else:
+            return line
@@ -0,0 +1,291 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+
+'''
+Line based diff engine, producing unified diffs without running an external
+``diff`` program.
+
+Lines are interned to integers first, so comparing lines is cheap. Common
+leading and trailing lines are skipped, and the remainder is split on lines
+that occur exactly once in both versions (as in patience diff). The gaps in
+between are compared using Myers' O(ND) algorithm.
+'''
+
+__all__ = ['opcodes', 'unified']
+
+
+import bisect
+
+
+# Maximum number of edits Myers' algorithm is allowed to look for in a single
+# gap, gaps that need more are reported as replaced entirely
+MYERS_LIMIT = 1000
+
+
+def intern(a, b):
+    '''
+    Map both sequences of lines to sequences of integers.
+    '''
+    table = {}
+    setdefault = table.setdefault
+    a = [setdefault(line, len(table)) for line in a]
+    b = [setdefault(line, len(table)) for line in b]
+    return a, b
+
+
+def unique(a, alo, ahi, b, blo, bhi):
+    '''
+    Find lines that occur exactly once in both ranges, and return the longest
+    sequence of them that appears in the same order in both.
+
+    :returns: list of ``(i, j)`` pairs of matching line numbers
+    '''
+    count = {}
+    for i in xrange(alo, ahi):
+        line = a[i]
+        if line in count:
+            count[line] = None
+        else:
+            count[line] = i
+    matches = {}
+    for j in xrange(blo, bhi):
+        line = b[j]
+        i = count.get(line)
+        if i is None:
+            continue
+        if line in matches:
+            matches[line] = None
+            count[line] = None
+        else:
+            matches[line] = (i, j)
+    pairs = sorted([pair for pair in matches.itervalues() if pair])
+    if not pairs:
+        return []
+
+    # Longest increasing subsequence on j, patience sorting
+    tails = []
+    links = {}
+    keys = []
+    for pair in pairs:
+        index = bisect.bisect_left(keys, pair[1])
+        if index == len(keys):
+            keys.append(pair[1])
+            tails.append(pair)
+        else:
+            keys[index] = pair[1]
+            tails[index] = pair
+        links[pair] = index and tails[index - 1] or None
+
+    result = []
+    pair = tails[-1]
+    while pair:
+        result.append(pair)
+        pair = links[pair]
+    result.reverse()
+    return result
+
+
+def myers(a, alo, ahi, b, blo, bhi, limit=MYERS_LIMIT):
+    '''
+    Find the matching lines between two ranges using Myers' algorithm.
+
+    :returns: list of ``(i, j)`` pairs of matching line numbers, or ``None``
+              if more than ``limit`` edits are needed
+    '''
+    n = ahi - alo
+    m = bhi - blo
+    v = {1: 0}
+    trace = []
+    for d in xrange(0, min(n + m, limit) + 1):
+        trace.append(v.copy())
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return backtrack(trace, alo, blo, n, m, d, k)
+    return None
+
+
+def backtrack(trace, alo, blo, x, y, d, k):
+    pairs = []
+    while d > 0:
+        v = trace[d]
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            k = k + 1
+            px = v[k]
+            py = px - k
+            sx, sy = px, py + 1
+        else:
+            k = k - 1
+            px = v[k]
+            py = px - k
+            sx, sy = px + 1, py
+        # Diagonal (snake) after the edit
+        while x > sx and y > sy:
+            x -= 1
+            y -= 1
+            pairs.append((alo + x, blo + y))
+        x, y = px, py
+        d -= 1
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        pairs.append((alo + x, blo + y))
+    pairs.reverse()
+    return pairs
+
+
+def matching(a, b):
+    '''
+    Find the matching lines between two sequences of interned lines.
+
+    :returns: list of ``(i, j)`` pairs of matching line numbers
+    '''
+    pairs = []
+    # Ranges still to be compared
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+
+        # Common prefix and suffix
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            pairs.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            pairs.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+
+        anchors = unique(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            for i, j in anchors:
+                pairs.append((i, j))
+                if i > alo or j > blo:
+                    stack.append((alo, i, blo, j))
+                alo, blo = i + 1, j + 1
+            stack.append((alo, ahi, blo, bhi))
+        else:
+            pairs.extend(myers(a, alo, ahi, b, blo, bhi) or [])
+
+    pairs.sort()
+    return pairs
+
+
+def opcodes(a, b):
+    '''
+    Compare two sequences of lines.
+
+    :returns: list of ``(tag, i1, i2, j1, j2)`` tuples, as returned by
+              :py:meth:`difflib.SequenceMatcher.get_opcodes`
+    '''
+    a, b = intern(a, b)
+    result = []
+    i = j = 0
+    for x, y in matching(a, b) + [(len(a), len(b))]:
+        if i < x and j < y:
+            result.append(('replace', i, x, j, y))
+        elif i < x:
+            result.append(('delete', i, x, j, y))
+        elif j < y:
+            result.append(('insert', i, x, j, y))
+        if x < len(a) and y < len(b):
+            if result and result[-1][0] == 'equal':
+                tag, i1, i2, j1, j2 = result[-1]
+                result[-1] = (tag, i1, x + 1, j1, y + 1)
+            else:
+                result.append(('equal', x, x + 1, y, y + 1))
+        i, j = x + 1, y + 1
+    return result
+
+
+def grouped(codes, context=3):
+    '''
+    Group opcodes into hunks with up to ``context`` lines of context.
+    '''
+    if not codes:
+        return
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = (tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2)
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = (tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context))
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # Split the hunk on large unchanged ranges
+        if tag == 'equal' and i2 - i1 > context * 2:
+            group.append((tag, i1, i1 + context, j1, j1 + context))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def format_range(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '%d' % (beginning,)
+    if not length:
+        beginning -= 1
+    return '%d,%d' % (beginning, length)
+
+
+def unified(a, b, fromfile='', tofile='', context=3):
+    '''
+    Produce a unified diff between two lists of lines, the lines should
+    include their line endings.
+
+    :param a: old lines
+    :param b: new lines
+    :param fromfile: name of the old file
+    :param tofile: name of the new file
+    :param context: number of lines of context
+
+    :returns: unified diff, empty if the sequences are equal
+    '''
+    output = []
+    for group in grouped(opcodes(a, b), context):
+        if not output:
+            output.append('--- %s\n' % (fromfile,))
+            output.append('+++ %s\n' % (tofile,))
+        output.append('@@ -%s +%s @@\n' % (
+            format_range(group[0][1], group[-1][2]),
+            format_range(group[0][3], group[-1][4])))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                lines = [(' ', line) for line in a[i1:i2]]
+            else:
+                lines = [('-', line) for line in a[i1:i2]]
+                lines.extend([('+', line) for line in b[j1:j2]])
+            for sign, line in lines:
+                output.append(sign + line)
+                if not line.endswith('\n'):
+                    output.append('\n\\ No newline at end of file\n')
+    return ''.join(output)
@@ -0,0 +1,631 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+
+__all__ = ['GitRepository']
+
+
+import binascii
+import hashlib
+import os
+import socket
+import struct
+import time
+import zlib
+from ranrod.repository import Repository, RepositoryError
+
+
+# Object types, as used in pack files
+OBJECT_TYPE = dict(
+    commit = 1,
+    tree   = 2,
+    blob   = 3,
+    tag    = 4,
+)
+
+# File modes
+MODE_FILE = 0100644
+MODE_EXEC = 0100755
+
+# Index file entry: ctime, ctime_ns, mtime, mtime_ns, dev, ino, mode, uid, gid,
+# size, SHA-1 and flags
+INDEX_ENTRY = struct.Struct('>10L20sH')
+
+
+class GitRepository(Repository):
+    '''
+    Repository backend that writes git objects directly, without running the
+    ``git`` binary for every file.
+
+    Blobs, trees and commits are written as loose objects into
+    ``.git/objects``, and the branch ``HEAD`` points to is updated (including
+    its reflog). The index is kept in sync with the last commit, so the
+    repository can be used with the regular git tools. Objects written
+    during a run are packed when the repository is closed.
+
+    Diffs are produced by :py:mod:`ranrod.diff`, like for every other
+    backend.
+
+    :param path: path to the repository
+    :param config: repository configuration
+    '''
+
+    def __init__(self, path, **config):
+        self.entries = None
+        self.head_tree = None
+        self.written = []
+        # Pack index data by file name, see pack_indexes
+        self.indexes = {}
+        super(GitRepository, self).__init__(path, **config)
+
+    @property
+    def git_dir(self):
+        return os.path.join(self.path, '.git')
+
+    def git_path(self, *parts):
+        return os.path.join(self.git_dir, *parts)
+
+    def check(self):
+        '''
+        Check if the repository has been initialized.
+        '''
+        return os.path.isfile(self.git_path('HEAD'))
+
+    def init(self):
+        '''
+        Create an empty repository.
+        '''
+        with self.lock:
+            for path in [('objects', 'info'), ('objects', 'pack'),
+                ('refs', 'heads'), ('refs', 'tags'), ('info',)]:
+                path = self.git_path(*path)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+
+            self.write_file(self.git_path('HEAD'), 'ref: refs/heads/master\n')
+            self.write_file(self.git_path('config'), '\n'.join([
+                '[core]',
+                '\trepositoryformatversion = 0',
+                '\tfilemode = true',
+                '\tbare = false',
+                '\tlogallrefupdates = true',
+                '',
+            ]))
+            self.write_file(self.git_path('info', 'exclude'),
+                '/%s/\n' % (self.meta,))
+
+    # Objects
+
+    def object_path(self, sha):
+        return self.git_path('objects', sha[:2], sha[2:])
+
+    def read_object(self, sha):
+        '''
+        Read a loose object, or a packed object that is not stored as a
+        delta.
+
+        :returns: tuple of object type and data, or ``None`` if there is no
+                  such object (that we can read)
+        '''
+        try:
+            with open(self.object_path(sha), 'rb') as handle:
+                data = zlib.decompress(handle.read())
+        except (IOError, zlib.error):
+            return self.read_packed(sha)
+
+        header, data = data.split('\0', 1)
+        return header.split(' ', 1)[0], data
+
+    def pack_indexes(self):
+        '''
+        Get the data of all version 2 pack indexes, as tuples of the index
+        file name and its data. Pack files never change, so every index is
+        read once.
+        '''
+        base = self.git_path('objects', 'pack')
+        try:
+            names = [name for name in os.listdir(base)
+                if name.endswith('.idx')]
+        except OSError:
+            return []
+
+        indexes = []
+        for name in sorted(names):
+            if name not in self.indexes:
+                with open(os.path.join(base, name), 'rb') as handle:
+                    data = handle.read()
+                if data[:8] != '\377tOc' + struct.pack('>L', 2):
+                    data = None
+                self.indexes[name] = data
+            if self.indexes[name] is not None:
+                indexes.append((name, self.indexes[name]))
+        return indexes
+
+    def find_packed(self, sha):
+        '''
+        Look up an object in the pack indexes.
+
+        :returns: tuple of the index file name and the offset of the object
+                  in the pack, or ``None`` if it is not packed
+        '''
+        binary = binascii.unhexlify(sha)
+        table = 8 + 1024
+        for name, data in self.pack_indexes():
+            fanout = struct.unpack_from('>256L', data, 8)
+            count = fanout[255]
+            lo = ord(binary[0]) and fanout[ord(binary[0]) - 1] or 0
+            hi = fanout[ord(binary[0])]
+            while lo < hi:
+                mid = (lo + hi) // 2
+                other = data[table + mid * 20:table + mid * 20 + 20]
+                if other < binary:
+                    lo = mid + 1
+                elif other > binary:
+                    hi = mid
+                else:
+                    break
+            else:
+                continue
+
+            offset = struct.unpack_from('>L', data,
+                table + count * 24 + mid * 4)[0]
+            if offset & 0x80000000:
+                offset = struct.unpack_from('>Q', data,
+                    table + count * 28 + (offset & 0x7fffffff) * 8)[0]
+            return name, offset
+
+        return None
+
+    def read_packed(self, sha):
+        '''
+        Look up an object in the pack files, objects stored as a delta are
+        not supported.
+        '''
+        names = dict((code, name) for name, code in OBJECT_TYPE.iteritems())
+        found = self.find_packed(sha)
+        if found is None:
+            return None
+
+        name, offset = found
+        pack = os.path.join(self.git_path('objects', 'pack'),
+            name[:-4] + '.pack')
+        with open(pack, 'rb') as handle:
+            handle.seek(offset)
+            head = handle.read(32)
+            kind = (ord(head[0]) >> 4) & 7
+            used = 1
+            while ord(head[used - 1]) & 0x80:
+                used += 1
+            if not kind in names:
+                # Delta
+                return None
+            handle.seek(offset + used)
+            decompress = zlib.decompressobj()
+            output = []
+            while not decompress.unused_data:
+                chunk = handle.read(65536)
+                if not chunk:
+                    break
+                output.append(decompress.decompress(chunk))
+            return names[kind], ''.join(output)
+
+    def write_object(self, kind, data):
+        '''
+        Write a loose object, if it does not exist already (loose or
+        packed).
+
+        :returns: hex SHA-1 of the object
+        '''
+        data = '%s %d\0%s' % (kind, len(data), data)
+        sha = hashlib.sha1(data).hexdigest()
+        path = self.object_path(sha)
+        # Content that went back to an earlier version is packed already
+        if not os.path.exists(path) and self.find_packed(sha) is None:
+            base = os.path.dirname(path)
+            if not os.path.isdir(base):
+                os.makedirs(base)
+            self.write_file(path, zlib.compress(data, 1))
+            self.written.append(sha)
+        return sha
+
+    def write_file(self, path, data):
+        '''
+        Atomically replace a file in the repository.
+        '''
+        temp = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp, 'wb') as handle:
+            handle.write(data)
+        os.rename(temp, path)
+
+    # References
+
+    def head_ref(self):
+        '''
+        Get the name of the branch ``HEAD`` points to.
+        '''
+        with open(self.git_path('HEAD')) as handle:
+            head = handle.read().strip()
+        if head.startswith('ref: '):
+            return head[5:]
+        else:
+            raise RepositoryError('Detached HEAD is not supported')
+
+    def read_ref(self, ref):
+        '''
+        Get the hex SHA-1 a reference points to, or ``None``.
+        '''
+        try:
+            with open(self.git_path(*ref.split('/'))) as handle:
+                return handle.read().strip()
+        except IOError:
+            pass
+
+        try:
+            with open(self.git_path('packed-refs')) as handle:
+                for line in handle:
+                    if line[:1] in '#^':
+                        continue
+                    sha, name = line.strip().split(' ', 1)
+                    if name == ref:
+                        return sha
+        except IOError:
+            pass
+
+        return None
+
+    def update_ref(self, ref, old, new, message):
+        '''
+        Point ``ref`` to ``new``, logging the update in the reflog.
+        '''
+        path = self.git_path(*ref.split('/'))
+        lock = path + '.lock'
+        base = os.path.dirname(path)
+        if not os.path.isdir(base):
+            os.makedirs(base)
+        try:
+            fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError, e:
+            raise RepositoryError('Unable to lock %s: %s' % (ref, str(e)))
+        try:
+            os.write(fd, new + '\n')
+        finally:
+            os.close(fd)
+        os.rename(lock, path)
+
+        entry = '%s %s %s\t%s\n' % (old or '0' * 40, new, self.signature(),
+            message.splitlines()[0])
+        for log in [self.git_path('logs', 'HEAD'),
+            self.git_path('logs', *ref.split('/'))]:
+            base = os.path.dirname(log)
+            if not os.path.isdir(base):
+                os.makedirs(base)
+            with open(log, 'a') as handle:
+                handle.write(entry)
+
+    def signature(self, user=None):
+        user = user or self.config.get('user') or 'ranrod'
+        email = self.config.get('email') or 'ranrod@%s' % (socket.getfqdn(),)
+        if type(user) == unicode:
+            user = user.encode('utf-8')
+        if type(email) == unicode:
+            email = email.encode('utf-8')
+        return '%s <%s> %d +0000' % (user, email, int(time.time()))
+
+    # Index
+
+    def relative(self, path):
+        '''
+        Get the path relative to the repository root, as stored in git.
+        '''
+        path = os.path.relpath(self.join(path), self.path)
+        return path.replace(os.sep, '/')
+
+    def load_index(self):
+        '''
+        Load the index, falls back to scanning the working tree if there is
+        no index (or if we can't read it).
+        '''
+        if self.entries is not None:
+            return self.entries
+
+        try:
+            self.entries = self.read_index()
+        except (IOError, ValueError, struct.error):
+            self.entries = {}
+            for root, dirs, files in os.walk(self.path):
+                if root == self.path:
+                    for name in ['.git', self.meta]:
+                        if name in dirs:
+                            dirs.remove(name)
+                for name in files:
+                    self.stage(os.path.join(root, name))
+
+        return self.entries
+
+    def read_index(self):
+        '''
+        Read a version 2 index file.
+        '''
+        with open(self.git_path('index'), 'rb') as handle:
+            data = handle.read()
+
+        if data[:4] != 'DIRC':
+            raise ValueError('Invalid index signature')
+        version, count = struct.unpack('>LL', data[4:12])
+        if version != 2:
+            raise ValueError('Unsupported index version %d' % (version,))
+        if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+            raise ValueError('Index checksum mismatch')
+
+        entries = {}
+        offset = 12
+        for x in xrange(count):
+            entry = INDEX_ENTRY.unpack_from(data, offset)
+            offset += INDEX_ENTRY.size
+            end = data.index('\0', offset)
+            name = data[offset:end]
+            size = INDEX_ENTRY.size + len(name)
+            offset += len(name) + 8 - (size % 8)
+            entries[name] = entry[:11]
+
+        return entries
+
+    def write_index(self):
+        '''
+        Write the index as a version 2 index file.
+        '''
+        data = ['DIRC', struct.pack('>LL', 2, len(self.entries))]
+        for name in sorted(self.entries):
+            entry = INDEX_ENTRY.pack(*(self.entries[name] +
+                (min(len(name), 0xfff),)))
+            size = len(entry) + len(name)
+            data.extend([entry, name, '\0' * (8 - (size % 8))])
+
+        data = ''.join(data)
+        self.write_file(self.git_path('index'),
+            data + hashlib.sha1(data).digest())
+
+    def stage(self, path):
+        '''
+        Add the current contents of a file to the in-memory index, or remove
+        it from the index if the file no longer exists.
+        '''
+        def ns(stamp):
+            return int((stamp - int(stamp)) * 1000000000)
+
+        entries = self.load_index()
+        name = self.relative(path)
+        path = self.join(path)
+        try:
+            info = os.stat(path)
+        except OSError:
+            entries.pop(name, None)
+            return
+
+        # Only rehash the file if it changed since we last staged it
+        entry = entries.get(name)
+        if entry and entry[2:4] == (int(info.st_mtime) & 0xffffffff,
+            ns(info.st_mtime)) and entry[5] == info.st_ino & 0xffffffff and \
+            entry[9] == info.st_size & 0xffffffff:
+            sha = entry[10]
+        else:
+            with open(path, 'rb') as handle:
+                sha = binascii.unhexlify(self.write_object('blob',
+                    handle.read()))
+
+        if info.st_mode & 0111:
+            mode = MODE_EXEC
+        else:
+            mode = MODE_FILE
+
+        entries[name] = tuple([value & 0xffffffff for value in (
+            int(info.st_ctime), ns(info.st_ctime),
+            int(info.st_mtime), ns(info.st_mtime),
+            info.st_dev, info.st_ino, mode, info.st_uid, info.st_gid,
+            info.st_size)] + [sha])
+
+    # Trees and commits
+
+    def write_tree(self):
+        '''
+        Write the tree objects for the in-memory index.
+
+        :returns: hex SHA-1 of the root tree
+        '''
+        root = {}
+        for name, entry in self.load_index().iteritems():
+            parts = name.split('/')
+            node = root
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = entry
+        return self.write_tree_node(root)
+
+    def write_tree_node(self, node):
+        items = []
+        for name, value in node.iteritems():
+            if isinstance(value, dict):
+                sha = binascii.unhexlify(self.write_tree_node(value))
+                # Directories sort as if they had a trailing slash
+                items.append((name + '/', '40000', name, sha))
+            else:
+                items.append((name, '%o' % (value[6],), name, value[10]))
+        items.sort()
+        return self.write_object('tree', ''.join(['%s %s\0%s' % item[1:]
+            for item in items]))
+
+    def commit(self, message='update', user='ranrod'):
+        '''
+        Commit the in-memory index, if it differs from the current ``HEAD``.
+
+        :returns: hex SHA-1 of the new commit, or ``None``
+        '''
+        ref = self.head_ref()
+        parent = self.read_ref(ref)
+        if parent and self.head_tree is None:
+            info = self.read_object(parent)
+            if info and info[0] == 'commit':
+                self.head_tree = info[1][5:45]
+
+        tree = self.write_tree()
+        if tree == self.head_tree:
+            # Nothing changed
+            return None
+
+        if type(message) == unicode:
+            message = message.encode('utf-8')
+        data = ['tree %s' % (tree,)]
+        if parent:
+            data.append('parent %s' % (parent,))
+        data.append('author %s' % (self.signature(user),))
+        data.append('committer %s' % (self.signature(user),))
+        data.extend(['', message, ''])
+        sha = self.write_object('commit', '\n'.join(data))
+
+        if parent:
+            log = 'commit: %s' % (message,)
+        else:
+            log = 'commit (initial): %s' % (message,)
+        self.update_ref(ref, parent, sha, log)
+        self.write_index()
+        self.head_tree = tree
+        return sha
+
+    # Repository interface
+
+    def file_add(self, path, message='update'):
+        with self.lock:
+            for path in self.paths(path):
+                self.stage(path)
+
+    def file_commit(self, path, message='update', user='ranrod'):
+        with self.lock:
+            for path in self.paths(path):
+                self.stage(path)
+            return self.commit(message, user)
+
+    def commit_paths(self, paths, message='update'):
+        with self.lock:
+            for path in paths:
+                self.stage(path)
+            return self.commit(message)
+
+    def paths(self, path):
+        if isinstance(path, basestring):
+            return [path]
+        else:
+            return path
+
+    def close(self):
+        '''
+        Pack the objects written during this run.
+        '''
+        with self.lock:
+            self.pack()
+        super(GitRepository, self).close()
+
+    def pack(self):
+        '''
+        Move the loose objects written during this run into a pack file.
+
+        :returns: hex SHA-1 of the pack, or ``None`` if there was nothing
+                  to pack
+        '''
+        objects = []
+        for sha in sorted(set(self.written)):
+            info = self.read_object(sha)
+            if info is not None:
+                objects.append((binascii.unhexlify(sha), info[0], info[1]))
+        if not objects:
+            return None
+
+        base = self.git_path('objects', 'pack')
+        if not os.path.isdir(base):
+            os.makedirs(base)
+
+        # Pack file, objects are stored without deltas
+        offsets = {}
+        crcs = {}
+        digest = hashlib.sha1()
+        temp = os.path.join(base, 'tmp_pack_%d' % (os.getpid(),))
+        with open(temp, 'wb') as handle:
+            def write(data):
+                digest.update(data)
+                handle.write(data)
+
+            offset = 0
+            head = struct.pack('>4sLL', 'PACK', 2, len(objects))
+            write(head)
+            offset += len(head)
+            for sha, kind, data in objects:
+                size = len(data)
+                header = [(OBJECT_TYPE[kind] << 4) | (size & 0x0f)]
+                size >>= 4
+                while size:
+                    header[-1] |= 0x80
+                    header.append(size & 0x7f)
+                    size >>= 7
+                chunk = ''.join(map(chr, header)) + zlib.compress(data, 1)
+                offsets[sha] = offset
+                crcs[sha] = binascii.crc32(chunk) & 0xffffffff
+                write(chunk)
+                offset += len(chunk)
+
+            checksum = digest.digest()
+            handle.write(checksum)
+
+        # Index file, version 2
+        shas = sorted(offsets)
+        fanout = [0] * 256
+        for sha in shas:
+            fanout[ord(sha[0])] += 1
+        for x in xrange(1, 256):
+            fanout[x] += fanout[x - 1]
+
+        large = []
+        small = []
+        for sha in shas:
+            if offsets[sha] < 0x80000000:
+                small.append(offsets[sha])
+            else:
+                small.append(0x80000000 | len(large))
+                large.append(offsets[sha])
+
+        data = ''.join([
+            '\377tOc', struct.pack('>L', 2),
+            struct.pack('>256L', *fanout),
+            ''.join(shas),
+            ''.join([struct.pack('>L', crcs[sha]) for sha in shas]),
+            ''.join([struct.pack('>L', offset) for offset in small]),
+            ''.join([struct.pack('>Q', offset) for offset in large]),
+            checksum,
+        ])
+        data += hashlib.sha1(data).digest()
+
+        name = os.path.join(base, 'pack-%s' % (binascii.hexlify(checksum),))
+        os.rename(temp, name + '.pack')
+        self.write_file(name + '.idx', data)
+
+        # Loose objects are no longer needed
+        for sha, kind, data in objects:
+            path = self.object_path(binascii.hexlify(sha))
+            os.unlink(path)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                # Directory not empty
+                pass
+        self.written = []
+        return binascii.hexlify(checksum)
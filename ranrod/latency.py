@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+# Timeout if there is no history, as in ranrod.client.base.Client.defaults
+DEFAULT_TIMEOUT = 30.0
+
+
+class Latency(object):
+    '''
+    Latencies observed while collecting a device, and the timeouts derived
+    from them. Observations are kept per step:
+
+    * ``connect``: seconds it took to connect
+    * ``login``: longest wait for data from the device while logging in
+    * ``command <line>``: longest wait for data from the device while it was
+      running a command
+    * ``gap``: longest wait for data from the device at any step but connect
+
+    The history is kept as a decaying peak: an observation higher than the
+    history replaces it, a lower one only pulls the history down a bit, so a
+    single fast run does not make the timeouts too tight.
+
+    A step that timed out is allowed ``growth`` times its timeout next run,
+    but only if it succeeded before and did not time out in the previous run
+    as well; a hung or dead device does not get ever longer timeouts.
+
+    Timeouts are ``timeout_factor`` times the peak latency of a step, within
+    ``timeout_floor`` and ``timeout_ceiling``. A ``timeout`` (or
+    ``connect_timeout``) in the device configuration is used as is, and
+    ``adaptive = no`` disables the derived timeouts.
+
+    :param config: device configuration
+    :param history: observations of earlier runs, see
+                    :py:meth:`ranrod.repository.Repository.latency`
+    '''
+
+    # Weight of an observation that is lower than the history
+    decay = 0.2
+    # Timeout of a step that timed out is multiplied by this, once
+    growth = 1.5
+
+    def __init__(self, config, history=None):
+        self.history = dict(history or {})
+        self.observed = {}
+        # Timeouts of the steps that timed out in this run
+        self.expiries = {}
+        self.fixed = config.get('timeout')
+        self.fixed_connect = config.get('connect_timeout') or self.fixed
+        self.adaptive = config.get('adaptive', True)
+        self.floor = float(config.get('timeout_floor', 5.0))
+        self.ceiling = float(config.get('timeout_ceiling', 120.0))
+        self.factor = float(config.get('timeout_factor', 4.0))
+        # The step we last gave a timeout for, see expired
+        self.last = None
+
+    def observe(self, key, seconds):
+        '''
+        Record the latency of step ``key`` in this run.
+        '''
+        if seconds > self.observed.get(key, 0):
+            self.observed[key] = seconds
+        if key != 'connect' and seconds > self.observed.get('gap', 0):
+            self.observed['gap'] = seconds
+
+    def expired(self):
+        '''
+        Record that the step we last gave a timeout for timed out, so the
+        next run may allow it more time. It is not an observation of the
+        longest wait, so it does not affect the ``gap``.
+        '''
+        if self.last is not None:
+            key, timeout = self.last
+            self.expiries[key] = timeout
+
+    def peak(self, key):
+        '''
+        Highest latency of step ``key`` known, or ``None``.
+        '''
+        if key in self.observed or key in self.history:
+            return max(self.observed.get(key, 0), self.history.get(key, 0))
+        return None
+
+    def timeout(self, key):
+        '''
+        Timeout for step ``key``; steps we have no history for use the
+        longest wait for data seen at any step.
+        '''
+        if key == 'connect':
+            fixed = self.fixed_connect
+        else:
+            fixed = self.fixed
+        if fixed:
+            timeout = float(fixed)
+        elif not self.adaptive:
+            timeout = DEFAULT_TIMEOUT
+        else:
+            peak = self.peak(key)
+            if peak is None and key != 'connect':
+                peak = self.peak('gap')
+            if peak is None:
+                timeout = DEFAULT_TIMEOUT
+            else:
+                timeout = min(self.ceiling, max(self.floor,
+                    peak * self.factor))
+        self.last = (key, timeout)
+        return timeout
+
+    def values(self):
+        '''
+        The history, updated with the observations of this run.
+        '''
+        values = dict(self.history)
+        for key, value in self.observed.iteritems():
+            old = values.get(key)
+            if old is None or value >= old:
+                values[key] = value
+            else:
+                values[key] = old + (value - old) * self.decay
+            if not key in self.expiries:
+                values.pop('expired %s' % (key,), None)
+
+        for key, timeout in self.expiries.iteritems():
+            marker = 'expired %s' % (key,)
+            if key in self.history and not marker in self.history:
+                values[key] = max(values.get(key, 0),
+                    timeout * self.growth / self.factor)
+            values[marker] = 1.0
+        return values
@@ -13,8 +13,13 @@ __copyright__ = 'Copyright 2011, maze.io labs'
 __license__   = 'MIT'
 
 
+import Queue
+import atexit
 import datetime
+import json
 import sys
+import threading
+import time
 
 
 # Named levels
@@ -28,44 +33,200 @@ LEVELS = dict(
     severe   = 3,
 )
 
-
-def Logger(*args, **kwargs):
-    class LoggerBase(object):
-        defaults = {
-            'level':  LEVELS['info'],
-            'output': '-',
-        }
-        instance = None
-
-        def __init__(self, config={}):
-            self.config = self.defaults.copy()
-            self.config.update(config)
-
-            if type(self.config['level']) != int:
-                self.config['level'] = LEVELS[self.config['level']]
-
-            if self.config['output'] == '-':
-                self.output = sys.stdout
-            else:
-                self.output = open(self.config['output'], 'a')
-
-            self('Log starting', level='info')
-
-        def __call__(self, message, level='info'):
-            return self.write(message, level)
-
-        def close(self):
-            self('Log closing', level='info')
-
-        def write(self, message, level='info'):
-            if type(level) != int:
-                level = LEVELS.get(level, self.config['level'])
-            
-            if level >= self.config['level']:
-                self.output.write('%s %s\n' % (datetime.datetime.now(), message))
-
-    if not LoggerBase.instance:
-        LoggerBase.instance = LoggerBase(*args, **kwargs)
-
-    return LoggerBase.instance
-        
\ No newline at end of file
+# Level names used in the output
+NAMES = {
+    0: 'debug',
+    1: 'info',
+    2: 'warning',
+    3: 'critical',
+}
+
+
+def get_level(level, default=LEVELS['info']):
+    if type(level) in (int, long):
+        return int(level)
+    else:
+        return LEVELS.get(level, default)
+
+
+class Log(object):
+    '''
+    Log output. Messages are formatted and written by a background thread,
+    so logging from the collector threads only costs a queue put, and lines
+    from different threads never interleave.
+
+    :param level: minimum level of the messages to write
+    :param output: path to the log file, or ``-`` for standard output
+    :param format: ``text`` or ``json`` (JSON lines)
+    '''
+
+    def __init__(self, level='info', output='-', format='text'):
+        self.level = get_level(level)
+        self.format = format
+        if output == '-':
+            self.output = sys.stdout
+        else:
+            self.output = open(output, 'a', 65536)
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def emit(self, level, message, context):
+        '''
+        Queue a message, the caller should have checked the ``level``.
+        '''
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.writer,
+                        name='ranrod-log')
+                    self.thread.daemon = True
+                    self.thread.start()
+        self.queue.put((time.time(), level, message, context))
+
+    def writer(self):
+        '''
+        Background writer, writes all queued messages and flushes the output
+        once the queue runs empty.
+        '''
+        running = True
+        while running:
+            records = [self.queue.get()]
+            try:
+                while True:
+                    records.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            lines = []
+            for record in records:
+                if record is None:
+                    running = False
+                else:
+                    lines.append(self.formatted(*record))
+            self.output.write(''.join(lines))
+            self.output.flush()
+
+    def formatted(self, stamp, level, message, context):
+        if self.format == 'json':
+            record = dict(context)
+            record.update({
+                'time':    datetime.datetime.fromtimestamp(stamp).isoformat(),
+                'level':   NAMES.get(level, level),
+                'message': message,
+            })
+            return json.dumps(record) + '\n'
+
+        elif context:
+            tags = [str(context[key]) for key in ('device', 'protocol')
+                if key in context]
+            if 'elapsed' in context:
+                tags.append('+%.3fs' % (context['elapsed'],))
+            return '%s [%s] %s\n' % (datetime.datetime.fromtimestamp(stamp),
+                ' '.join(tags), message)
+
+        else:
+            return '%s %s\n' % (datetime.datetime.fromtimestamp(stamp),
+                message)
+
+    def close(self):
+        '''
+        Write all queued messages and stop the writer.
+        '''
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+        if self.output is not sys.stdout:
+            self.output.flush()
+
+
+# Default output, see configure
+output = Log()
+
+
+def configure(config={}):
+    '''
+    Replace the default log output, used by all :py:class:`Logger` instances
+    that were not given an output of their own.
+
+    :param config: :py:class:`Log` options
+    '''
+    global output
+    options = dict([(key, config[key]) for key in ('level', 'output', 'format')
+        if key in config])
+    previous, output = output, Log(**options)
+    previous.close()
+    return output
+
+
+class Logger(object):
+    '''
+    Logger, adds context to messages and passes them to a :py:class:`Log`
+    output. Messages below the output level are dropped before any
+    formatting takes place.
+
+    Loggers are cheap, create one for every device or subsystem and pass
+    the context as keyword arguments::
+
+        >>> log = Logger(device='router', protocol='ssh')
+        >>> log('Connected')
+
+    :param config: if given, (re)configure the default output (deprecated,
+                   use :py:func:`configure`)
+    :param log: :py:class:`Log` output, defaults to the default output
+    :param context: context added to every message, ``device`` and
+                    ``protocol`` are shown in text output
+    '''
+
+    def __init__(self, config=None, log=None, **context):
+        self.log = log
+        self.context = context
+        self.started = None
+        if config is not None:
+            configure(config)
+            self('Log starting')
+
+    def __call__(self, message, level='info'):
+        return self.write(message, level)
+
+    def bind(self, **context):
+        '''
+        Get a logger with additional context, the elapsed time is shared
+        with this logger.
+        '''
+        logger = Logger(log=self.log, **self.context)
+        logger.context.update(context)
+        logger.started = self.started
+        return logger
+
+    def enabled(self, level='info'):
+        '''
+        Check if messages at ``level`` will be written, use this to avoid
+        building expensive messages.
+        '''
+        return get_level(level) >= (self.log or output).level
+
+    def start(self):
+        '''
+        Start the clock, messages will include the time elapsed since.
+        '''
+        self.started = time.time()
+
+    def write(self, message, level='info'):
+        log = self.log or output
+        level = get_level(level, log.level)
+        if level < log.level:
+            return
+
+        if self.started is None:
+            context = self.context
+        else:
+            context = dict(self.context, elapsed=time.time() - self.started)
+        log.emit(level, message, context)
+
+    def close(self):
+        self('Log closing')
+        (self.log or output).close()
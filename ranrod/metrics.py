@@ -0,0 +1,312 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+import BaseHTTPServer
+import threading
+from ranrod.logger import Logger
+
+
+# Default histogram buckets (in seconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    30.0, 60.0)
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"',
+        r'\"')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    elif type(value) in (int, long):
+        return str(value)
+    else:
+        return repr(float(value))
+
+
+class Metric(object):
+    '''
+    Metric base class, a metric has a value for every combination of label
+    values, see :py:meth:`labels`.
+
+    :param name: metric name
+    :param help: description of the metric
+    :param labels: names of the labels
+    '''
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self.child = self.children[()] = self.create()
+
+    def create(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        '''
+        Get the child metric for the given label values, keep a reference to
+        the child in hot code paths to avoid the lookup.
+        '''
+        values = tuple(map(str, values))
+        try:
+            return self.children[values]
+        except KeyError:
+            if len(values) != len(self.labelnames):
+                raise ValueError('Metric %s expects labels %s' % (self.name,
+                    ', '.join(self.labelnames)))
+            with self.lock:
+                return self.children.setdefault(values, self.create())
+
+    def samples(self):
+        '''
+        Get all samples, as (suffix, labels, value) tuples.
+        '''
+        with self.lock:
+            children = self.children.items()
+        for values, child in sorted(children):
+            labels = zip(self.labelnames, values)
+            for suffix, extra, value in child.samples():
+                yield suffix, labels + extra, value
+
+    def exposition(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help.replace('\\', r'\\')),
+            '# TYPE %s %s' % (self.name, self.kind),
+        ]
+        for suffix, labels, value in self.samples():
+            if labels:
+                labels = '{%s}' % (','.join(['%s="%s"' % (label, escape(text))
+                    for label, text in labels]),)
+            else:
+                labels = ''
+            lines.append('%s%s%s %s' % (self.name, suffix, labels,
+                format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class CounterValue(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', [], self.value)]
+
+
+class Counter(Metric):
+    '''
+    Counter, a value that only goes up.
+    '''
+
+    kind = 'counter'
+
+    def create(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.child.inc(amount)
+
+
+class GaugeValue(object):
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        '''
+        Get the value from calling ``function`` when the gauge is exported.
+        '''
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return [('', [], self.value)]
+        else:
+            return [('', [], self.function())]
+
+
+class Gauge(Metric):
+    '''
+    Gauge, a value that can go up and down.
+    '''
+
+    kind = 'gauge'
+
+    def create(self):
+        return GaugeValue()
+
+    def inc(self, amount=1):
+        self.child.inc(amount)
+
+    def dec(self, amount=1):
+        self.child.dec(amount)
+
+    def set(self, value):
+        self.child.set(value)
+
+    def set_function(self, function):
+        self.child.set_function(function)
+
+
+class HistogramValue(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.sum += value
+            self.count += 1
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    def samples(self):
+        with self.lock:
+            counts = self.counts[:]
+            total, count = self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, value in zip(self.buckets, counts):
+            cumulative += value
+            samples.append(('_bucket', [('le', format_value(bound))],
+                cumulative))
+        samples.append(('_bucket', [('le', '+Inf')], count))
+        samples.append(('_sum', [], total))
+        samples.append(('_count', [], count))
+        return samples
+
+
+class Histogram(Metric):
+    '''
+    Histogram, counts observed values in buckets.
+
+    :param buckets: upper bounds of the buckets
+    '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, help, labels)
+
+    def create(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.child.observe(value)
+
+
+class Registry(object):
+    '''
+    Collection of metrics, exported in the Prometheus text exposition
+    format.
+    '''
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                return self.metrics[metric.name]
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def exposition(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        return ''.join([metric.exposition() for name, metric in metrics])
+
+
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        data = self.server.registry.exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        Logger()('metrics: %s %s' % (self.client_address[0], format % args),
+            level='debug')
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    '''
+    HTTP server exporting a :py:class:`Registry` on ``/metrics``, it runs in
+    a background thread, see :py:meth:`start`.
+
+    :param address: (host, port) to listen on
+    :param registry: :py:class:`Registry` to export
+    '''
+
+    allow_reuse_address = True
+
+    def __init__(self, address, registry=registry):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MetricsHandler)
+        self.registry = registry
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+            name='ranrod-metrics')
+        thread.daemon = True
+        thread.start()
+        return thread
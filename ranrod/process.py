@@ -0,0 +1,201 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+import Queue
+import itertools
+import multiprocessing
+import os
+import threading
+from ranrod.logger import Logger, configure
+from ranrod.repository import Repository
+from ranrod.scheduler import Scheduler
+
+
+class RemoteRepository(Repository):
+    '''
+    Repository used in a worker process. Configurations are dumped to
+    temporary files in the repository as usual, but replacing files,
+    committing and recording fingerprints, connect methods and latencies is
+    left to the parent process.
+
+    :param repository: the parent :py:class:`ranrod.repository.Repository`
+    :param queue: queue to the parent process
+    '''
+
+    def __init__(self, repository, queue):
+        self.path = repository.path
+        self.config = repository.config
+        self.queue = queue
+        self.lock = threading.RLock()
+        self.logger = Logger()
+        self.counter = itertools.count()
+        # Snapshots taken when the worker was started
+        self.digests = dict(repository.load_digests())
+        self.fingerprints = dict(repository.load_fingerprints())
+        self.methods = dict(repository.load_methods())
+        self.latencies = dict(repository.load_latencies())
+
+    def replace(self, filename, temp, digest):
+        if digest == self.digest(filename):
+            os.unlink(temp)
+            return False
+        else:
+            self.queue.put(('replace', filename, temp, digest))
+            return True
+
+    def update(self, path, message='update', digest=None):
+        self.queue.put(('update', path, message, digest))
+
+    def set_fingerprint(self, filename, fingerprint):
+        self.queue.put(('fingerprint', filename, fingerprint))
+
+    def set_method(self, filename, method):
+        self.queue.put(('method', filename, method))
+
+    def set_latency(self, filename, latency):
+        self.queue.put(('latency', filename, latency))
+
+    def close(self):
+        pass
+
+
+class RemoteStatus(object):
+    '''
+    Status log used in a worker process, rows are sent to the parent.
+    '''
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def device_up(self, device):
+        self.queue.put(('status', device.name, device.hostname, 'up'))
+
+    def device_down(self, device, reason=''):
+        if reason:
+            reason = reason.splitlines()[0]
+        self.queue.put(('status', device.name, device.hostname, 'down',
+            reason))
+
+
+class Processes(object):
+    '''
+    Collects devices using a pool of worker processes, so Telnet decoding
+    and filtering can use more than one core. The devices are sharded over
+    the workers, each worker collects its shard using its own
+    :py:class:`ranrod.scheduler.Scheduler`, clients and log output.
+
+    The parent process remains the only writer of the repository and the
+    status log: workers send their results back, see :py:meth:`dispatch`.
+
+    :param processes: number of worker processes
+    :param repository: :py:class:`ranrod.repository.Repository` instance
+    :param log: log configuration for the workers
+    '''
+
+    def __init__(self, processes, repository, log={}):
+        self.processes = max(1, int(processes))
+        self.repository = repository
+        self.log = log
+        self.status = None
+        self.logger = Logger()
+        # Files replaced on behalf of the workers
+        self.replaced = None
+
+    def run(self, devices, collect, status, workers=1):
+        '''
+        Collect ``devices`` and block until all workers are done.
+
+        :param devices: list of device configurations
+        :param collect: function to collect a device, called as
+                        ``collect(device, repository, status)``
+        :param status: :py:class:`ranrod.status.Status` instance
+        :param workers: number of worker threads per process
+        '''
+        queue = multiprocessing.Queue()
+        self.status = status
+        self.replaced = set()
+        # Take the snapshots before forking
+        self.repository.load_digests()
+        self.repository.load_fingerprints()
+        self.repository.load_methods()
+        self.repository.load_latencies()
+
+        children = []
+        for x in xrange(min(self.processes, len(devices))):
+            child = multiprocessing.Process(target=self.worker,
+                args=(devices[x::self.processes], collect, workers, queue),
+                name='ranrod-process-%d' % (x,))
+            child.start()
+            children.append(child)
+
+        running = dict([(child.pid, child) for child in children])
+        while running:
+            try:
+                message = queue.get(timeout=0.5)
+            except Queue.Empty:
+                # Notice workers that died without saying goodbye
+                for pid, child in running.items():
+                    if not child.is_alive():
+                        del running[pid]
+                        self.logger('%s exited with status %s' % (
+                            child.name, child.exitcode), level='critical')
+                continue
+
+            if message[0] == 'done':
+                running.pop(message[1], None)
+            else:
+                self.dispatch(message)
+
+        for child in children:
+            child.join()
+
+    def worker(self, devices, collect, workers, queue):
+        # Threads are not inherited, so the parent's log writer is not ours
+        configure(self.log)
+        repository = RemoteRepository(self.repository, queue)
+        status = RemoteStatus(queue)
+        scheduler = Scheduler(workers)
+        for device in devices:
+            scheduler.add(collect, device, repository, status)
+        scheduler.run()
+        queue.put(('done', os.getpid()))
+        queue.close()
+        queue.join_thread()
+        Logger().close()
+
+    def dispatch(self, message):
+        '''
+        Handle a message from a worker.
+        '''
+        kind, args = message[0], message[1:]
+        if kind == 'status':
+            self.status.log(*args)
+        elif kind == 'replace':
+            filename, temp, digest = args
+            if self.repository.replace(filename, temp, digest):
+                self.replaced.add(filename)
+        elif kind == 'update':
+            filename, message, digest = args
+            # The file may have turned out to be unchanged after all
+            if filename in self.replaced:
+                self.replaced.discard(filename)
+                self.repository.update(filename, message=message,
+                    digest=digest)
+        elif kind == 'fingerprint':
+            self.repository.set_fingerprint(*args)
+        elif kind == 'method':
+            self.repository.set_method(*args)
+        elif kind == 'latency':
+            self.repository.set_latency(*args)
@@ -13,9 +13,26 @@ __copyright__ = 'Copyright 2011, maze.io labs'
 __license__   = 'MIT'
 
 
+import contextlib
+import hashlib
+import itertools
 import os
+import pipes
 import shlex
 import subprocess
+import threading
+import urllib
+import urlparse
+from ranrod.diff import unified
+from ranrod.logger import Logger
+from ranrod.metrics import registry
+from ranrod.timing import timings
+
+
+COMMANDS = registry.counter('ranrod_repository_commands_total',
+    'Version control commands run', ['command'])
+COMMITTED = registry.counter('ranrod_repository_committed_files_total',
+    'Files committed')
 
 
 class RepositoryError(Exception):
@@ -25,15 +42,43 @@ class RepositoryError(Exception):
 class Repository(object):
     '''
     Repository handling.
+
+    The repository keeps a content digest of every file it committed, and
+    the previous version of every changed file in the ``.ranrod`` directory,
+    see :py:meth:`replace`. Diffs are produced from those, without running
+    the version control system.
     
     :param path: path to the repository
     :param config: repository configuration
     '''
+
+    # Directory for ranrod's own (untracked) files
+    meta = '.ranrod'
+
     def __init__(self, path, **config):
         self.path = os.path.abspath(path)
         if type(self.path) is unicode:
             self.path = self.path.encode('utf-8')
         self.config = config
+        self.logger = Logger()
+        # Serialises file and VCS operations between collector threads
+        self.lock = threading.RLock()
+        # Paths waiting to be committed, if batching
+        self.batched = None
+        self.batch_size = 0
+        self.batch_message = 'update'
+        # Content digests of committed files, and of batched files
+        self.digests = None
+        self.pending = {}
+        # Change fingerprints of devices
+        self.fingerprints = None
+        # Connect methods that last collected the devices
+        self.methods = None
+        # Latencies observed while collecting the devices
+        self.latencies = None
+        self.counter = itertools.count()
+        # Files replaced during this run
+        self.changed = []
 
         if not self.check():
             self.init()
@@ -58,9 +103,307 @@ class Repository(object):
         '''
         path = self.join(filename)
         base = os.path.dirname(path)
+        with self.lock:
+            if not os.path.isdir(base):
+                os.makedirs(base)
+        return open(path, mode)
+
+    def open_temp(self, filename):
+        '''
+        Opens a new temporary file, to be moved in place of ``filename`` by
+        :py:meth:`replace`.
+
+        :param filename: file name the temporary file is meant for
+        '''
+        base = os.path.join(self.path, self.meta, 'tmp')
+        with self.lock:
+            if not os.path.isdir(base):
+                os.makedirs(base)
+            name = '%s.%d.%d' % (os.path.basename(filename), os.getpid(),
+                self.counter.next())
+        return open(os.path.join(base, name), 'wb')
+
+    def name(self, path):
+        '''
+        Get the name of a file relative to the repository root.
+        '''
+        return os.path.relpath(self.join(path), self.path)
+
+    def digest(self, filename):
+        '''
+        Get the content digest of ``filename`` as it was last committed, or
+        ``None`` if we don't know.
+        '''
+        name = self.name(filename)
+        with self.lock:
+            return self.load_digests().get(name)
+
+    def load_digests(self):
+        if self.digests is None:
+            self.digests = self.load_table('digests')
+        return self.digests
+
+    def save_digests(self):
+        '''
+        Save the content digests of the committed files.
+        '''
+        with self.lock:
+            if self.digests is not None:
+                self.save_table('digests', self.digests)
+
+    def fingerprint(self, filename):
+        '''
+        Get the change fingerprint of ``filename`` as it was last collected,
+        or ``None`` if we don't know, see
+        :py:meth:`ranrod.device.base.Device.cmd_fingerprint`.
+        '''
+        name = self.name(filename)
+        with self.lock:
+            return self.load_fingerprints().get(name)
+
+    def set_fingerprint(self, filename, fingerprint):
+        name = self.name(filename)
+        with self.lock:
+            self.load_fingerprints()[name] = fingerprint
+
+    def load_fingerprints(self):
+        if self.fingerprints is None:
+            self.fingerprints = self.load_table('fingerprints')
+        return self.fingerprints
+
+    def save_fingerprints(self):
+        '''
+        Save the change fingerprints of the collected files.
+        '''
+        with self.lock:
+            if self.fingerprints is not None:
+                self.save_table('fingerprints', self.fingerprints)
+
+    def method(self, filename):
+        '''
+        Get the connect method that last collected ``filename``, or ``None``
+        if we don't know, see :py:func:`ranrod.client.try_connect`.
+        '''
+        name = self.name(filename)
+        with self.lock:
+            return self.load_methods().get(name)
+
+    def set_method(self, filename, method):
+        name = self.name(filename)
+        with self.lock:
+            self.load_methods()[name] = method
+
+    def load_methods(self):
+        if self.methods is None:
+            self.methods = self.load_table('methods')
+        return self.methods
+
+    def save_methods(self):
+        '''
+        Save the connect methods that collected the files.
+        '''
+        with self.lock:
+            if self.methods is not None:
+                self.save_table('methods', self.methods)
+
+    def latency(self, filename):
+        '''
+        Get the latencies observed while collecting ``filename``, see
+        :py:class:`ranrod.latency.Latency`.
+
+        :returns: ``dict`` of latencies by step
+        '''
+        name = self.name(filename)
+        with self.lock:
+            value = self.load_latencies().get(name, '')
+        latency = {}
+        for key, seconds in urlparse.parse_qsl(value):
+            try:
+                latency[key] = float(seconds)
+            except ValueError:
+                pass
+        return latency
+
+    def set_latency(self, filename, latency):
+        name = self.name(filename)
+        value = urllib.urlencode([(key, '%.4f' % (seconds,))
+            for key, seconds in sorted(latency.iteritems())])
+        with self.lock:
+            self.load_latencies()[name] = value
+
+    def load_latencies(self):
+        if self.latencies is None:
+            self.latencies = self.load_table('latency')
+        return self.latencies
+
+    def save_latencies(self):
+        '''
+        Save the latencies observed while collecting the files.
+        '''
+        with self.lock:
+            if self.latencies is not None:
+                self.save_table('latency', self.latencies)
+
+    def load_table(self, table):
+        '''
+        Load a table of ``value  name`` lines from the ``.ranrod`` directory.
+        '''
+        entries = {}
+        try:
+            with open(os.path.join(self.path, self.meta, table)) as handle:
+                for line in handle:
+                    value, name = line.rstrip('\n').split('  ', 1)
+                    entries[name] = value
+        except (IOError, ValueError):
+            pass
+        return entries
+
+    def save_table(self, table, entries):
+        base = os.path.join(self.path, self.meta)
         if not os.path.isdir(base):
             os.makedirs(base)
-        return open(path, mode)
+        path = os.path.join(base, table)
+        with open(path + '.tmp', 'w') as handle:
+            for name in sorted(entries):
+                handle.write('%s  %s\n' % (entries[name], name))
+        os.rename(path + '.tmp', path)
+
+    def replace(self, filename, temp, digest):
+        '''
+        Atomically move the temporary file ``temp`` (see :py:meth:`open_temp`)
+        in place of ``filename``, unless the content ``digest`` equals that
+        of the file as it was last committed, in which case the temporary
+        file is removed.
+
+        :returns: boolean indicating if the file was replaced
+        '''
+        path = self.join(filename)
+        with self.lock:
+            if digest == self.digest(filename) and os.path.exists(path):
+                os.unlink(temp)
+                return False
+
+            base = os.path.dirname(path)
+            if not os.path.isdir(base):
+                os.makedirs(base)
+            # Keep the previous version around, for diffs
+            if os.path.exists(path):
+                previous = self.previous_path(filename)
+                base = os.path.dirname(previous)
+                if not os.path.isdir(base):
+                    os.makedirs(base)
+                os.rename(path, previous)
+            elif os.path.exists(self.previous_path(filename)):
+                os.unlink(self.previous_path(filename))
+            os.rename(temp, path)
+            self.changed.append(self.name(filename))
+            return True
+
+    def previous_path(self, filename):
+        '''
+        Location of the previous version of ``filename``.
+        '''
+        return os.path.join(self.path, self.meta, 'previous',
+            self.name(filename))
+
+    @contextlib.contextmanager
+    def batch(self, size=None, message='update'):
+        '''
+        Context in which :py:meth:`update` collects the changed paths, they
+        are added and committed all at once when the context exits, or every
+        ``size`` paths::
+
+            >>> with repository.batch(100):
+            ...     repository.update('config/router')
+            ...
+
+        :param size: number of paths to commit at once, ``0`` commits at the
+                     end only; defaults to the ``batch`` option in the
+                     repository configuration, if that is not set either
+                     every path is committed by :py:meth:`update` right away
+        :param message: commit message
+        '''
+        if size is None:
+            size = self.config.get('batch')
+        if size is None or size is False:
+            yield self
+            return
+
+        with self.lock:
+            self.batched = []
+            self.batch_size = int(size)
+            self.batch_message = message
+        try:
+            yield self
+        finally:
+            with self.lock:
+                try:
+                    self.flush()
+                finally:
+                    self.batched = None
+
+    def flush(self):
+        '''
+        Add and commit all paths collected in the current batch.
+        '''
+        with self.lock:
+            if not self.batched:
+                return
+
+            paths = self.batched
+            pending = self.pending
+            self.batched = []
+            self.pending = {}
+            with timings.measure('commit') as measure:
+                measure.size = len(paths)
+                self.commit_paths(paths, self.batch_message)
+            COMMITTED.inc(len(paths))
+            self.load_digests().update(pending)
+            self.save_digests()
+
+    def commit_paths(self, paths, message='update'):
+        '''
+        Add and commit a list of paths in one go.
+        '''
+        # Keep the command lines at a sane length
+        for offset in xrange(0, len(paths), 256):
+            self.file_add(self.quote(paths[offset:offset + 256]),
+                message=message)
+        self.file_commit(self.quote(paths), message=message)
+
+    def quote(self, paths):
+        '''
+        Quote a list of paths for use in a command template.
+        '''
+        return ' '.join(map(pipes.quote, paths))
+
+    def update(self, path, message='update', digest=None):
+        '''
+        Add and commit a changed file, or queue it if we are in a
+        :py:meth:`batch`.
+
+        :param path: path of the changed file
+        :param message: commit message (if not batching)
+        :param digest: content digest to record once the file is committed
+        '''
+        path = self.join(path)
+        with self.lock:
+            if self.batched is None:
+                with timings.measure('commit') as measure:
+                    measure.size = 1
+                    self.file_add(path, message=message)
+                    self.file_commit(path, message=message)
+                COMMITTED.inc()
+                if digest:
+                    self.load_digests()[self.name(path)] = digest
+                return
+
+            if not path in self.batched:
+                self.batched.append(path)
+            if digest:
+                self.pending[self.name(path)] = digest
+            if self.batch_size and len(self.batched) >= self.batch_size:
+                self.flush()
 
     def check(self):
         '''
@@ -81,27 +424,78 @@ class Repository(object):
             else:
                 command = shlex.split(command[0])
 
-        print 'shell:', ' '.join(command)
-        pipe = subprocess.Popen(command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        data = pipe.communicate()
+        self.logger('shell: %s' % (' '.join(command),), level='debug')
+        with self.lock:
+            COMMANDS.labels(os.path.basename(command[0])).inc()
+            with timings.measure('execute', command[0]) as measure:
+                pipe = subprocess.Popen(command,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+                data = pipe.communicate()
+                measure.size = len(data[0])
         if pipe.returncode > 0:
             raise RepositoryError(data[1] or data[0])
         else:
             return data[0]
 
+    def close(self):
+        '''
+        Called at the end of a run, saves the content digests, fingerprints,
+        connect methods, latencies and the list of files changed during this
+        run.
+        '''
+        self.save_digests()
+        self.save_fingerprints()
+        self.save_methods()
+        self.save_latencies()
+        with self.lock:
+            if self.changed:
+                path = os.path.join(self.path, self.meta, 'changed')
+                with open(path + '.tmp', 'w') as handle:
+                    for name in sorted(set(self.changed)):
+                        handle.write('%s\n' % (name,))
+                os.rename(path + '.tmp', path)
+                self.changed = []
+
+    def last_changed(self):
+        '''
+        Get the names of the files changed during the last run that changed
+        anything.
+        '''
+        with self.lock:
+            if self.changed:
+                return sorted(set(self.changed))
+        try:
+            with open(os.path.join(self.path, self.meta, 'changed')) as handle:
+                return [line.rstrip('\n') for line in handle]
+        except IOError:
+            return []
+
+    def read_lines(self, path):
+        try:
+            with open(path, 'rb') as handle:
+                return handle.readlines()
+        except IOError:
+            return []
+
+    def unified(self, name, old, new):
+        return unified(old, new, 'a/%s' % (name,), 'b/%s' % (name,))
+
     def diff(self):
-        command = self.config.get('diff') % {
-            'root': self.path,
-        }
-        return self.execute(command)
+        '''
+        Get the uncommitted changes to all files, see :py:meth:`file_diff`.
+        '''
+        with self.lock:
+            names = set(self.load_digests()) | set(self.pending)
+        return ''.join([self.file_diff(name) for name in sorted(names)])
 
     def diff_last(self):
-        command = self.config.get('diff-last') % {
-            'root': self.path,
-        }
-        return self.execute(command)
+        '''
+        Get the changes made to all files during the last run that changed
+        anything, see :py:meth:`file_diff_last`.
+        '''
+        return ''.join([self.file_diff_last(name)
+            for name in self.last_changed()])
 
     def file_add(self, path, message='update'):
         if not self.config.get('file-add'):
@@ -129,23 +523,53 @@ class Repository(object):
         return self.execute(command)
 
     def file_diff(self, path):
-        command = self.config.get('file-diff') % {
-            'root': self.path,
-            'path': path,
-        }
-        return self.execute(command)
+        '''
+        Get the uncommitted changes to a file as a unified diff, that is the
+        difference between the file as it was last committed and its current
+        contents.
+        '''
+        name = self.name(path)
+        current = self.read_lines(self.join(name))
+        digest = hashlib.sha1(''.join(current)).hexdigest()
+        if digest == self.digest(name):
+            return ''
+        else:
+            return self.unified(name,
+                self.read_lines(self.previous_path(name)), current)
 
     def file_diff_last(self, path):
-        command = self.config.get('file-diff-last') % {
-            'root': self.path,
-            'path': path,
-        }
-        return self.execute(command)
+        '''
+        Get the last change made to a file as a unified diff.
+        '''
+        name = self.name(path)
+        return self.unified(name, self.read_lines(self.previous_path(name)),
+            self.read_lines(self.join(name)))
 
     def init(self):
-        print 'Initializing repository in', self.path
+        self.logger('Initializing repository in %s' % (self.path,))
         command = self.config.get('create') % {
             'path': self.path,
         }
-        print 'Executing:', repr(command)
         return self.execute(command)
+
+
+def get_repository(path, **config):
+    '''
+    Get a repository instance for the configured ``backend``.
+
+    :param path: path to the repository
+    :param config: repository configuration, the ``backend`` option selects
+                   the implementation:
+
+        * ``template`` (default), run the commands from the template
+        * ``git``, write git objects directly, see
+          :py:class:`ranrod.git.GitRepository`
+    '''
+    backend = config.get('backend') or 'template'
+    if backend == 'template':
+        return Repository(path, **config)
+    elif backend == 'git':
+        from ranrod.git import GitRepository
+        return GitRepository(path, **config)
+    else:
+        raise RepositoryError('Unknown repository backend "%s"' % (backend,))
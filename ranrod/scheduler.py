@@ -0,0 +1,95 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+import Queue
+import threading
+import traceback
+from ranrod.logger import Logger
+from ranrod.metrics import registry
+
+
+QUEUED = registry.gauge('ranrod_scheduler_queued',
+    'Devices waiting to be collected')
+
+
+class Scheduler(object):
+    '''
+    Device collection scheduler, runs queued jobs on a pool of worker
+    threads so many devices can be handled at once.
+
+    Jobs are expected to handle their own errors, any exception that slips
+    through is logged and does not affect the other jobs.
+
+    :param workers: number of worker threads
+    '''
+
+    def __init__(self, workers=1):
+        self.workers = max(1, int(workers or 1))
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.logger = Logger()
+        QUEUED.set_function(self.queue.qsize)
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def add(self, func, *args, **kwargs):
+        '''
+        Queue a job.
+
+        :param func: callable to run in a worker thread
+        :param args: positional arguments for ``func``
+        :param kwargs: keyword arguments for ``func``
+        '''
+        self.queue.put((func, args, kwargs))
+
+    def run(self):
+        '''
+        Start the workers and block until all queued jobs are done.
+        '''
+        for x in xrange(min(self.workers, len(self))):
+            thread = threading.Thread(target=self.worker,
+                name='ranrod-worker-%d' % (x,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        # Join with a timeout, so we remain responsive to signals
+        while self.threads:
+            for thread in self.threads[:]:
+                thread.join(0.5)
+                if not thread.is_alive():
+                    self.threads.remove(thread)
+
+    def worker(self):
+        '''
+        Worker thread main loop, runs jobs until the queue is exhausted.
+        '''
+        while True:
+            try:
+                func, args, kwargs = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                func(*args, **kwargs)
+            except Exception, e:
+                self.logger('Unhandled error in %s: %s' % \
+                    (threading.current_thread().name, str(e)),
+                    level='critical')
+                for line in traceback.format_exc().splitlines():
+                    self.logger(line, level='debug')
+            finally:
+                self.queue.task_done()
@@ -13,13 +13,19 @@ __copyright__ = 'Copyright 2011, maze.io labs'
 __license__   = 'MIT'
 
 
+import hashlib
+import threading
+
+
 class Status(object):
     def __init__(self, repository):
         self.repository = repository
         self.status     = []
+        self.lock       = threading.Lock()
 
     def log(self, *args):
-        self.status.append(args)
+        with self.lock:
+            self.status.append(args)
 
     def device_up(self, device):
         '''
@@ -39,16 +45,24 @@ class Status(object):
         '''
         Save devices to the status log and commit the file.
         '''
-        self.status.sort()
-        log = self.repository.open('status', 'w')
-        log.write('\t'.join(['name', 'hostname', 'status', 'reason']))
-        log.write('\n')
-        for line in self.status:
-            log.write('\t'.join(line))
-            log.write('\n')
-        log.close()
-        self.repository.file_add(log.name, message='status update')
-        self.repository.file_commit(log.name)
+        with self.lock:
+            self.status.sort()
+            status = self.status[:]
+
+        data = ['\t'.join(['name', 'hostname', 'status', 'reason'])]
+        data.extend(['\t'.join(line) for line in status])
+        data = '\n'.join(data + [''])
+        if type(data) == unicode:
+            data = data.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+
+        with self.repository.lock:
+            log = self.repository.open_temp('status')
+            log.write(data)
+            log.close()
+            if self.repository.replace('status', log.name, digest):
+                self.repository.update('status', message='status update',
+                    digest=digest)
 
     def diff(self):
-        return self.repository.diff_last_file(self.repository.join('status'))
\ No newline at end of file
+        return self.repository.file_diff_last('status')
\ No newline at end of file
@@ -0,0 +1,173 @@
+#! /usr/bin/env python
+#                         _______
+#   ____________ _______ _\__   /_________       ___  _____
+#  |    _   _   \   _   |   ____\   _    /      |   |/  _  \
+#  |    /   /   /   /   |  |     |  /___/   _   |   |   /  /
+#  |___/___/   /___/____|________|___   |  |_|  |___|_____/
+#          \__/                     |___|
+#
+
+__author__    = 'Wijnand Modderman-Lenstra'
+__email__     = 'maze@pyth0n.org'
+__copyright__ = 'Copyright 2011, maze.io labs'
+__license__   = 'MIT'
+
+
+import json
+import math
+import os
+import threading
+import time
+from ranrod.metrics import registry
+
+
+STEPS = registry.histogram('ranrod_step_seconds',
+    'Duration of the steps of collecting a device, such as connect, login, '
+    'command and commit', ['step'])
+
+
+class Measure(object):
+    '''
+    Times a block of code, see :py:meth:`Timings.measure`. Set ``size`` to
+    record a byte count along with the duration.
+    '''
+
+    def __init__(self, timings, kind, name):
+        self.timings = timings
+        self.kind = kind
+        self.name = name
+        self.size = 0
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.timings.record(self.kind, self.name, time.time() - self.started,
+            self.size)
+
+
+class Timings(object):
+    '''
+    Collects durations and byte counts of the expensive steps of a run, such
+    as connecting, waiting for output, filtering and committing. Events are
+    attributed to the device being collected by the current thread, see
+    :py:meth:`begin`.
+    '''
+
+    # Number of entries in the slowest commands list
+    slowest = 10
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget all events, at the start of a run.
+        '''
+        with self.lock:
+            self.events = []
+            self.started = time.time()
+
+    def begin(self, device):
+        '''
+        Attribute events in the current thread to ``device``.
+        '''
+        self.local.device = device
+        self.local.started = time.time()
+
+    def end(self):
+        '''
+        Record the total time spent on the current device.
+        '''
+        started = getattr(self.local, 'started', None)
+        if started is not None:
+            self.record('device', self.local.device, time.time() - started)
+        self.local.device = None
+        self.local.started = None
+
+    def measure(self, kind, name=''):
+        '''
+        Time a block of code::
+
+            >>> with timings.measure('command', 'show version') as measure:
+            ...     measure.size = len(output)
+
+        '''
+        return Measure(self, kind, name)
+
+    def record(self, kind, name, duration, size=0):
+        event = (getattr(self.local, 'device', None), kind, name, duration,
+            size)
+        with self.lock:
+            self.events.append(event)
+        STEPS.labels(kind).observe(duration)
+
+    def report(self):
+        '''
+        Summarise the recorded events, per device and per kind of event,
+        with percentiles and the slowest commands.
+        '''
+        with self.lock:
+            events = self.events[:]
+            started = self.started
+
+        devices = {}
+        kinds = {}
+        for device, kind, name, duration, size in events:
+            if device is not None:
+                entry = devices.setdefault(device, {}).setdefault(kind,
+                    dict(count=0, time=0.0, bytes=0))
+                entry['count'] += 1
+                entry['time'] += duration
+                entry['bytes'] += size
+            kinds.setdefault(kind, []).append((duration, size))
+
+        summary = {}
+        for kind, values in kinds.iteritems():
+            durations = sorted([duration for duration, size in values])
+            summary[kind] = dict(
+                count = len(durations),
+                time = sum(durations),
+                bytes = sum([size for duration, size in values]),
+                p50 = percentile(durations, 50),
+                p90 = percentile(durations, 90),
+                p99 = percentile(durations, 99),
+                max = durations[-1],
+            )
+
+        commands = [event for event in events if event[1] == 'command']
+        commands.sort(key=lambda event: event[3], reverse=True)
+        return dict(
+            started = started,
+            duration = time.time() - started,
+            devices = devices,
+            kinds = summary,
+            slowest = [dict(device=device, command=name, time=duration,
+                bytes=size) for device, kind, name, duration, size
+                in commands[:self.slowest]],
+        )
+
+    def save(self, filename):
+        '''
+        Write the :py:meth:`report` to ``filename`` as JSON.
+        '''
+        with open(filename + '.tmp', 'w') as handle:
+            json.dump(self.report(), handle, indent=2, sort_keys=True)
+            handle.write('\n')
+        os.rename(filename + '.tmp', filename)
+
+
+def percentile(values, percent):
+    '''
+    Nearest-rank percentile of sorted ``values``.
+    '''
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+timings = Timings()
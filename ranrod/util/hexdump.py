@@ -16,39 +16,53 @@ __copyright__ = '(C) 2011 Wijnand Modderman-Lenstra'
 __license__   = 'MIT'
 __url__       = 'https://maze.io/'
 
+import binascii
 import sys
 
+
+# Translation table for the character column, non-printables become dots
+PRINTABLE = ''.join([(c >= 0x20 and c < 0x7f) and chr(c) or '.'
+    for c in xrange(256)])
+
+
 class HexDump(object):
-    def __init__(self, pad=1, step=16, buffer=sys.stdout):
+    def __init__(self, pad=1, step=16, buffer=None):
         self.pad = pad
         self.step = step
         # Make sure we have even steps
         if self.step % 2 != 0:
             self.step += 1
         self.buffer = buffer
+        self.width = (self.step / 2) * (4 + self.pad)
 
     def dump(self, data, encoding='utf8', offset=0):
         '''
         Dump the contents of a byte array, such as a string or an unicode
         object.
         '''
+        (self.buffer or sys.stdout).write(self.format(data, encoding, offset))
+
+    def format(self, data, encoding='utf8', offset=0):
+        '''
+        Format the contents of a byte array as a hex dump, the rows are
+        formatted using :py:func:`binascii.hexlify` and
+        :py:meth:`str.translate` instead of byte by byte.
+        '''
         if type(data) == unicode:
-            data = bytearray(data, encoding)
+            data = data.encode(encoding)
         else:
-            data = bytearray(data)
+            data = str(data)
+        pads = ' ' * self.pad
+        lines = []
         for y in xrange(0, len(data), self.step):
             part = data[y:y+self.step]
-            print '0x%04x ' % (y * self.step + offset,),
-            hexc = []
-            for x in xrange(0, len(part), 2):
-                if len(part[x:x+2]) == 1:
-                    hexc.append('%02x  ' % (part[x],))
-                else:
-                    hexc.append('%02x%02x' % tuple(part[x:x+2]))
+            hexc = binascii.hexlify(part)
+            hexc = pads.join([hexc[x:x+4].ljust(4)
+                for x in xrange(0, len(hexc), 4)])
+            lines.append('0x%04x  %s %s\n' % (y + offset,
+                hexc.ljust(self.width), part.translate(PRINTABLE)))
 
-            char = [(c >= 0x20 and c < 0x7f) and chr(c) or '.' for c in part]
-            pads = ' ' * self.pad
-            print pads.join(hexc).ljust((self.step / 2) * (4 + self.pad)), ''.join(char)
+        return ''.join(lines)
 
     def dump_stream(self, stream, encoding='utf8'):
         '''